@@ -5,6 +5,7 @@ from datams.flask import flask_init_app
 from datams.celery import celery_init_app
 from datams.flask_login import flask_login_init_app
 from datams.redis import redis_init_app
+from datams.utils import APP_CONFIG
 from datams.db import database_init_app
 
 # add this package to path to allow absolute imports
@@ -34,5 +35,16 @@ def create_app(test_config=None):
     # 5) initialize the login manager
     flask_login_init_app(app)
 
+    # 6) track the metrics (i.e. utilisation of the redis connection pools) when the
+    #    optional PROMETHEUS section is configured (requires prometheus-client)
+    if 'PROMETHEUS' in APP_CONFIG:
+        # NOTE: must be set before prometheus_client is first imported
+        multiproc_dir = os.environ.setdefault(
+            'PROMETHEUS_MULTIPROC_DIR', APP_CONFIG['PROMETHEUS']['multiproc_dir']
+        )
+        os.makedirs(multiproc_dir, exist_ok=True)
+        from datams.prom import prom_init_app
+        prom_init_app(app)
+
     return app
 
@@ -1,70 +1,119 @@
-from typing import Any
 from flask import Flask
 from celery import Celery, Task, shared_task
 
-from datams.redis import (get_value, set_value, set_working, set_finished,
-                          remove_stale_vkeys, is_working, requires_lock, get_redis)
-from datams.utils import (remove_stale_files, update_and_append_to_checkins,
-                          get_valid_checkins)
+from celery.signals import worker_ready
+
+from datams.redis import (get_value, set_working, finish_root, await_root,
+                          remove_stale_vkeys, is_working, try_acquire_lock,
+                          release_lock, get_redis, pop_changes, write_value,
+                          request_rebuild, pop_rebuild, has_requests,
+                          pop_stale_checkins, FRAME_KEYS)
+from datams.uploads import remove_stale_uploads
 from datams.db.queries.select import select_query
+from datams.db.utils import patch_df
+from datams.db.datatables import index_frame
+from datams.serialization import encode_df
 
 #  Note in order to know if value is ready application can check if the
 #  `<key>_lock` key exists.  If it doesn't then it should be ready.  Otherwise
 #  it is currently being computed and set
 
 
+def refresh_root(key) -> None:
+    # Run the rebuild and the patches requested for `key` unless another worker already
+    # holds its lock in which case the requests are left to it, i.e. a duplicate rebuild
+    # is merged into the one in progress rather than queued behind it.  The requests
+    # are checked again once the lock is released so none are missed.
+    # NOTE: Currently this method assumes all data coming from select_query is a pandas
+    #        Dataframe.
+    # NOTE: the lock is held for the whole computation so that changes applied while
+    #       it runs are never overwritten by a stale value
+    while has_requests(key):
+        token = try_acquire_lock(key)
+        if token is None:
+            return
+        try:
+            if pop_rebuild(key):
+                pop_changes(key)  # included in the rebuild
+                set_working(key)
+                value = index_frame(key, select_query(data=key))
+            else:
+                ids = pop_changes(key)
+                if not ids:
+                    continue
+                if get_redis().exists(f"{key}_generation") == 1:
+                    # index_frame only computes the search text of the patched rows
+                    rows = select_query(data=key, file_ids=ids)
+                    value = index_frame(key, patch_df(get_value(key), rows, ids))
+                else:
+                    value = index_frame(key, select_query(data=key))
+            # can't use the redis.set_value or we'll end up in deadlock
+            write_value(key, encode_df(value))
+            finish_root(key)
+        finally:
+            release_lock(key, token)
+
+
 # define background tasks
 @shared_task(name='compute_and_set')
 def compute_and_set_task(key) -> None:
-    # NOTE: Currently this method assumes all data coming from select_query is a pandas
-    #        Dataframe.
-    set_working(key)
-    value = select_query(data=key).to_json()
-    set_value(key, value)
-    set_finished(key)
+    request_rebuild(key)
+    refresh_root(key)
 
 
-@shared_task(name='set_vkey')
-def set_vkey_task(_, vkey):
-    set_working(vkey)
-    root_key = '.'.join(vkey.split('.')[3:])
-    value = get_value(root_key).to_json()
-    set_value(vkey, value)
-    set_finished(vkey)
+@shared_task(name='apply_changes')
+def apply_changes_task(key) -> None:
+    # NOTE: Only the rows published with `refresh_keys(changes=...)` are recomputed and
+    #       patched into the cached value.  The full `compute_and_set_task` is still
+    #       scheduled periodically as a consistency fallback.
+    refresh_root(key)
 
 
-def update_vkey(vkey):
-    set_working(vkey)
-    root_key = '.'.join(vkey.split('.')[3:])
-    chain = (compute_and_set_task.s(root_key) | set_vkey_task.s(vkey))
-    chain()
+def refresh_keys(*keys, changes: dict = None):
+    # Recompute `keys` and patch the changed rows of the keys in `changes` (i.e.
+    # dict(processed_files=[<File.id>, ...])).  All the keys are marked as working and
+    # the changes are published in a single round trip before the tasks are enqueued.
+    changes = {} if changes is None else changes
+    set_working(*keys, *changes.keys(), changes=changes)
+    for key in keys:
+        compute_and_set_task.delay(key)
+    for key in changes.keys():
+        apply_changes_task.delay(key)
 
 
-@shared_task(name='update')
-@requires_lock
-def update_task(key, value: Any) -> None:
-    # NOTE: if method isn't defined then value is simply set, but it is assumed that
-    #       its type is compatible
-    redis = get_redis()
-    methods = dict(
-        checkins=lambda x, y: str(update_and_append_to_checkins(get_value(x), y)),
-    )
-    new_value = methods.get(key, lambda x, y: y)(key, value)
-    # can't use the redis.set_value or we'll end up in deadlock
-    redis.set(key, new_value)
+def update_vkey(vkey):
+    root_key = '.'.join(vkey.split('.')[3:])
+    set_working(vkey)
+    if await_root(root_key, vkey):
+        # the root is already being recomputed or patched (i.e. after an edit) so the
+        # vkey simply references the result once it is finished (see finish_root)
+        return
+    # otherwise the root is rebuilt and the vkey references the result likewise
+    await_root(root_key, vkey, rebuild=True)
+    compute_and_set_task.delay(root_key)
 
 
 @shared_task(name='remove_stales')
 def remove_stales_task() -> None:
-    valid_uids = [uid for uid, _ in get_valid_checkins(get_value('checkins'))]
-    remove_stale_files(valid_uids)
-    remove_stale_vkeys(valid_uids)
+    stale_uids = pop_stale_checkins()
+    # NOTE: the uploads expire on their own (i.e. so they can be resumed from another
+    #       page once theirs is gone)
+    remove_stale_uploads()
+    remove_stale_vkeys(stale_uids)
 
 
 def task_complete(key) -> bool:
     return False if is_working(key) else True
 
 
+@worker_ready.connect
+def rebuild_frames(**_) -> None:
+    # computes the frames when a worker starts rather than whenever an app is created
+    # (i.e. by every web worker and command)
+    for key in FRAME_KEYS:
+        compute_and_set_task.delay(key)
+
+
 def celery_init_app(app: Flask) -> Celery:
     # 1) define flask/celery task object to share context variables
     class FlaskTask(Task):
@@ -79,11 +128,7 @@ def celery_init_app(app: Flask) -> Celery:
     celery_app.set_default()
     app.extensions['celery'] = celery_app
 
-    # 3) start background task of computing and setting various file types
-    compute_and_set_task.delay('processed_files')
-    compute_and_set_task.delay('pending_files')
-    compute_and_set_task.delay('discovered_files')
-    compute_and_set_task.delay('deleted_files')
+    # 3) the frames are computed once a worker is ready (see rebuild_frames)
 
     # 5) start period task of removing stale files
     celery_app.conf.beat_schedule = {
@@ -93,6 +138,12 @@ def celery_init_app(app: Flask) -> Celery:
             # 'args': ('remove_stales',),
             # 'kwargs': dict(key='remove_stale_files')
         },
+        # the processed_files are otherwise only patched (see `apply_changes_task`)
+        'rebuild_processed_files': {
+            'task': 'compute_and_set',
+            'schedule': app.config['DATA_FILES'].get('rebuild_every', 3600),
+            'args': ('processed_files',),
+        },
     }
     return celery_app
 
@@ -1,14 +1,17 @@
 import os
 import click
 import re
-from pathlib import Path
 import pandas as pd
 
-from sqlalchemy import select, update, delete, insert
+from sqlalchemy import select, update, delete, insert, or_
 from datams.utils import (APP_CONFIG, PROCESSED_DIRECTORY, DISCOVERY_DIRECTORY,
                           ALLOWED_CHARACTERS)
 from datams.db.core import query_df, query_all
-from datams.db.tables import File, User, wipe_db, initialize_db
+from datams.db.tables import (File, User, DiscoveredFile, wipe_db, initialize_db,
+                              migrate_db)
+from datams.discovery import watch, set_discovered_state
+from datams.walk import walk_files, realpath
+from datams.celery import refresh_keys
 from werkzeug.security import generate_password_hash
 # from psycopg2.errors import UniqueViolation
 from sqlalchemy.exc import IntegrityError
@@ -39,6 +42,16 @@ def init_db_command():
         click.echo('\nInitialization aborted.')
 
 
+@click.command('migrate-db')
+def migrate_db_command():
+    """
+    Add the columns and indexes missing from the existing tables (i.e. those added by
+    an update).  The indexes are built concurrently so the app can keep running.
+    """
+    migrate_db(APP_CONFIG)
+    click.echo('\nMigrated the database.')
+
+
 @click.command('resolve-files')
 def resolve_files_command():
     """
@@ -53,22 +66,15 @@ def resolve_files_command():
               'Do you want to continue? Y or [N]: ')
     if r.lower() == 'y':
         # 1. build the map of what files are present
-        fmap = {}
-        for f in Path(PROCESSED_DIRECTORY).rglob('*'):
-            if f.is_file():
-                path = os.path.realpath(str(f))
+        fmap, duplicates = {}, set()
+        for directory in [PROCESSED_DIRECTORY, DISCOVERY_DIRECTORY]:
+            for entry in walk_files(directory):
+                path = realpath(entry)
                 filename = os.path.basename(path)
                 if filename in fmap.keys():
                     fmap.pop(filename)  # ignore when multiple
-                else:
-                    fmap[filename] = path
-        for f in Path(DISCOVERY_DIRECTORY).rglob('*'):
-            if f.is_file():
-                path = os.path.realpath(str(f))
-                filename = os.path.basename(path)
-                if filename in fmap.keys():
-                    fmap.pop(filename)  # ignore when multiple
-                else:
+                    duplicates.add(filename)
+                elif filename not in duplicates:
                     fmap[filename] = path
 
         # 2. get all the files from database
@@ -111,6 +117,50 @@ def resolve_files_command():
         click.echo('\nFilename resolution aborted.')
 
 
+@click.command('watch-discoveries')
+def watch_discoveries_command():
+    """
+    Refresh the discovered files whenever files are added to, removed from or renamed
+    within the discovery directory (requires inotify_simple).
+    """
+    click.echo(f"\nWatching `{DISCOVERY_DIRECTORY}` for changes.")
+    watch(lambda: refresh_keys('discovered_files'))
+
+
+@click.command('unignore-files')
+@click.argument('paths', nargs=-1)
+def unignore_files_command(paths: tuple):
+    """
+    List the ignored discovered files again, either all of them or those at or within
+    the given PATHS.
+    """
+    stmt = select(DiscoveredFile.path).where(DiscoveredFile.state == 'ignored')
+    if paths:
+        paths = [os.path.abspath(p) for p in paths]
+        stmt = stmt.where(or_(*[
+            clause for p in paths for clause in [
+                DiscoveredFile.path == p,
+                DiscoveredFile.path.startswith(f"{p.rstrip('/')}/", autoescape=True)
+            ]
+        ]))
+    ignored = query_df(stmt)['path'].tolist()
+    set_discovered_state(ignored, 'seen')
+    refresh_keys('discovered_files')
+    click.echo(f"\nListed {len(ignored)} ignored file(s) again.")
+
+
+@click.command('serve-metrics')
+def serve_metrics_command():
+    """
+    Serve the metrics written by every process (requires the PROMETHEUS section of the
+    config and prometheus-client).
+    """
+    from datams.prom import serveMultiprocess
+    port = int(os.getenv('PROMETHEUS_PORT', APP_CONFIG['PROMETHEUS']['port']))
+    click.echo(f"\nServing the metrics on port {port}.")
+    serveMultiprocess(port)
+
+
 @click.command('create-user')
 @click.argument('username', nargs=1)
 @click.option('--email', prompt=True)
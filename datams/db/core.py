@@ -47,6 +47,18 @@ def query_all(statements: list) -> None:
     return
 
 
+def query_all_scalars(statements: list) -> list:
+    """
+    execute all statements within a single transaction and return the first scalar
+    of each result (i.e. the ids from an `insert(...).returning(Table.id)`)
+    """
+    engine = get_engine()
+    with Session(engine) as session:
+        scalars = [session.execute(statement).scalar() for statement in statements]
+        session.commit()
+    return scalars
+
+
 def query_first_df(statement):
     """
     return query results as a series empty series if None
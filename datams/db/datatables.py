@@ -1,5 +1,15 @@
 import flask
-from datams.redis import get_value
+import datetime as dt
+import numpy as np
+import pandas as pd
+from sqlalchemy import select, func, and_
+from datams.utils import APP_CONFIG
+from datams.redis import get_value, get_total, set_total
+from datams.db.core import query_df, query_first
+from datams.db.utils import escape_like
+from datams.db.queries.select import (
+    processed_files_statement, deleted_files_statement, full_text_clauses
+)
 
 """
     # The draw counter that this object is a response to - from the draw parameter sent
@@ -25,41 +35,78 @@ from datams.redis import get_value
 """
 
 
-# TODO: Wrap the common bits into functions for reuse
+# Note values 100 and up are provided, but not displayed and can be accessed by the
+# template.  They are also not used when filtered or ordered.
+COLUMN_MAPS = dict(
+    processed_files={
+        0: 'level', 1: 'filename', 2: 'owner', 3: 'description', 4: 'uploaded',
+        100: 'id', 101: 'url'  # 101: 'name',  100: 'filepath'
+    },
+    pending_files={
+        0: 'filename', 1: 'uploaded', 2: 'uploaded_by', 100: 'id'
+        # 101: 'name', 100: 'filepath'
+    },
+    discovered_files={
+        0: 'filename', 1: 'last_modified', 100: 'id'  # 101: 'name', 100: 'filepath'
+    },
+    # TODO: Consider adding 'deleted_by' and 'uploaded_by' to columns
+    deleted_files={
+        0: 'filename', 1: 'description', 2: 'uploaded', 3: 'deleted',
+        100: 'id', 101: 'original_id', 102: 'ftype'
+    },
+)
+
+# lowercased text searched by fetch_frame (see index_frame)
+SEARCH_COLUMN = '_search'
+# prefix of the columns holding the (ascending) sort permutation of each displayed
+# column, i.e. `_order_filename` (see index_frame)
+ORDER_PREFIX = '_order_'
+
+# The tables listed under `sql_fetch` in the optional `DATATABLES` section of the config
+# file are filtered, ordered and paged by the database (see fetch_sql) instead of from
+# the cached frames (see fetch_frame).  Note these always show the current state of the
+# database rather than the snapshot of the user's last refresh and that their global
+# search is the full-text search (see datams.db.queries.select.full_text_clauses) which
+# only the columns it doesn't cover (see VECTOR_COLUMNS) are also matched against.
+DATATABLES_CONFIG = APP_CONFIG.get('DATATABLES', {})
+SQL_FETCH = DATATABLES_CONFIG.get('sql_fetch', [])
+# seconds the (unfiltered) total of these tables is reused before it is counted again
+TOTAL_EXPIRY = DATATABLES_CONFIG.get('total_expiry', 10)
+SQL_STATEMENTS = dict(
+    processed_files=processed_files_statement,
+    deleted_files=deleted_files_statement,
+)
+# columns stored as timestamps in the database
+TIMESTAMP_COLUMNS = ['uploaded', 'deleted']
+TIMESTAMP_FORMAT = dict(python='%Y-%m-%d %H:%M:%S', sql='YYYY-MM-DD HH24:MI:SS')
+
+# How the per-column search (`columns[i][search][value]`) of a column is applied, any
+# column not listed matches when every space separated term is found in it
+# (case-insensitively).
+#   range: `<from>|<to>` where both are `YYYY-MM-DD[ HH:MM:SS]`, either may be omitted
+#          and a `to` date includes the entire day
+#   exact: the value must be equal
+COLUMN_FILTERS = dict(
+    uploaded='range', deleted='range', last_modified='range',
+    level='exact', owner='exact',
+)
+RANGE_DELIMITER = '|'
+# the displayed columns whose words are part of the search vector of a File/DeletedFile
+# (see SEARCH_VECTOR in datams.db.tables)
+VECTOR_COLUMNS = ['filename', 'description']
+
+
 def fetch(request: flask.Request):
-    # Note values 100 and up are provided, but not displayed and can be accessed by the
-    # template.  They are also not used when filtered or ordered.
-    column_maps = dict(
-        processed_files={
-            0: 'level', 1: 'filename', 2: 'owner', 3: 'description', 4: 'uploaded',
-            100: 'id', 101: 'url'  # 101: 'name',  100: 'filepath'
-        },
-        pending_files={
-            0: 'filename', 1: 'uploaded', 2: 'uploaded_by', 100: 'id'
-            # 101: 'name', 100: 'filepath'
-        },
-        discovered_files={
-            0: 'filename', 1: 'last_modified', 100: 'id'  # 101: 'name', 100: 'filepath'
-        },
-        # TODO: Consider adding 'deleted_by' and 'uploaded_by' to columns
-        deleted_files={
-            0: 'filename', 1: 'description', 2: 'uploaded', 3: 'deleted',
-            100: 'id', 101: 'original_id', 102: 'ftype'
-        },
-    )
-    request_values = request.values
+    params = parse_request(request)
+    if params['ftype'] in SQL_FETCH and params['ftype'] in SQL_STATEMENTS.keys():
+        return fetch_sql(params)
+    return fetch_frame(params)
 
-    uploads_id = request_values['uploads_id']
-    ftype = request_values['ftype']
-    draw = request_values['draw']
-    start = int(request_values['start'])
-    length = int(request_values['length'])
 
-    cmap = column_maps[ftype]
-    icmap = {v: k for k, v in cmap.items()}
+def parse_request(request: flask.Request) -> dict:
+    request_values = request.values
 
     column_attributes = {}
-
     for k, v in request_values.items():
         if k.startswith('columns'):
             if k.endswith('[orderable]'):
@@ -74,45 +121,290 @@ def fetch(request: flask.Request):
                 cargs = column_attributes.get(cidx, dict())
                 cargs[key] = False if v == 'false' else True
                 column_attributes[cidx] = cargs
-    df = get_value(f"vkey.{uploads_id}.{ftype}")[[v for v in cmap.values()]]
-    search_value = request_values['search[value]']
-    if search_value != '':
-        for i in ['.', '+', '?', '^', '$', '|', '&']:
-            search_value = search_value.replace(i, f"\\{i}")
-        re = '^' + ''.join([f"(?=.*{w})" for w in search_value.split(' ') if w != ''])
-        searchable = df.assign(
-            a=eval(" + ' ' + ".join(
-                [f"df['{v}'].astype(str)" for k, v in cmap.items() if k < 100])
-            )
-        )['a']
-        df_filtered = df.loc[searchable.str.contains(re, case=False), :]
+            elif k.endswith('[search][value]'):
+                key = 'search'
+                cidx = int(k[8:-16])
+                cargs = column_attributes.get(cidx, dict())
+                cargs[key] = v
+                column_attributes[cidx] = cargs
+
+    # order[i][column] and order[i][dir] are sent for every ordered column (in order)
+    order = []
+    i = 0
+    while f"order[{i}][column]" in request_values:
+        cidx = int(request_values[f"order[{i}][column]"])
+        if column_attributes.get(cidx, dict()).get('orderable', False):
+            order.append((cidx, request_values.get(f"order[{i}][dir]") != 'desc'))
+        i += 1
+
+    # column index: search value
+    column_search = {
+        cidx: cargs['search'] for cidx, cargs in column_attributes.items()
+        if cargs.get('searchable', False) and cargs.get('search', '').strip() != ''
+    }
+
+    return dict(
+        uploads_id=request_values['uploads_id'],
+        ftype=request_values['ftype'],
+        draw=int(request_values['draw']),
+        start=int(request_values['start']),
+        length=int(request_values['length']),
+        search=request_values['search[value]'],
+        order=order,  # [(column index, ascending), ...]
+        column_search=column_search,
+        columns=column_attributes,
+    )
+
+
+def _search_text(df: pd.DataFrame, cmap: dict) -> pd.Series:
+    # all the displayed columns separated by spaces and lowercased
+    if df.empty:
+        return pd.Series('', index=df.index, dtype=object)
+    columns = [df[v].fillna('').astype(str) for k, v in cmap.items() if k < 100]
+    text = columns[0]
+    for c in columns[1:]:
+        text = text + ' ' + c
+    return text.str.lower()
+
+
+def _sort_permutation(column: pd.Series) -> np.ndarray:
+    # row positions of the case-insensitive (stable) ascending order, nulls last
+    keys = column.reset_index(drop=True)
+    keys = keys.where(keys.notna()).astype(object).str.lower()
+    return keys.sort_values(kind='stable', na_position='last').index.to_numpy()
+
+
+def index_frame(key: str, df: pd.DataFrame) -> pd.DataFrame:
+    # Adds the columns fetch_frame uses to filter and order the frame of `key` (a
+    # ftype), this is done once when the frame is cached rather than on every request.
+    # NOTE: the search text is only computed for the rows missing it (i.e. the rows
+    #       patched in by apply_changes) but the permutations always cover every row
+    if key not in COLUMN_MAPS.keys():
+        return df
+    cmap = COLUMN_MAPS[key]
+    df = df.reset_index(drop=True)
+    if SEARCH_COLUMN in df.columns:
+        missing = df[SEARCH_COLUMN].isna()
+        if missing.any():
+            df.loc[missing, SEARCH_COLUMN] = _search_text(df.loc[missing, :], cmap)
     else:
-        df_filtered = df
+        df = df.assign(**{SEARCH_COLUMN: _search_text(df, cmap)})
+    if df.empty:
+        return df
+    return df.assign(**{f"{ORDER_PREFIX}{v}": _sort_permutation(df[v])
+                        for k, v in cmap.items() if k < 100})
+
+
+def _ordered_positions(df: pd.DataFrame, column: str, ascending: bool) -> np.ndarray:
+    positions = df[f"{ORDER_PREFIX}{column}"].to_numpy()
+    if ascending:
+        return positions
+    # reverse the non-null part only so the nulls stay last
+    valid = int(df[column].notna().sum())
+    return np.concatenate([positions[:valid][::-1], positions[valid:]])
+
+
+def _search_mask(searchable: pd.Series, search_value: str) -> pd.Series:
+    # every space separated term must be found (case-insensitively) in the search text
+    mask = pd.Series(True, index=searchable.index)
+    for term in search_value.lower().split(' '):
+        if term != '':
+            mask &= searchable.str.contains(term, regex=False)
+    return mask
+
+
+def _parse_range(value: str) -> tuple:
+    # returns the (inclusive) start and (exclusive) end datetimes of a range filter,
+    # either of which is None when omitted or invalid
+    bounds = [b.strip() for b in value.split(RANGE_DELIMITER, 1)] + ['']
+    parsed = []
+    for bound, is_end in zip(bounds[:2], [False, True]):
+        try:
+            parsed.append(dt.datetime.strptime(bound, TIMESTAMP_FORMAT['python']) +
+                          (dt.timedelta(seconds=1) if is_end else dt.timedelta()))
+        except ValueError:
+            try:
+                parsed.append(dt.datetime.strptime(bound, '%Y-%m-%d') +
+                              (dt.timedelta(days=1) if is_end else dt.timedelta()))
+            except ValueError:
+                parsed.append(None)
+    return tuple(parsed)
+
 
-    by = []
-    ascending = []
-    cidx = int(request_values['order[0][column]'])
-    if column_attributes[cidx]['orderable']:
-        by.append(cmap[cidx])
-        ascending.append(request_values['order[0][dir]'] == 'asc')
+def _column_mask(column: pd.Series, value: str) -> pd.Series:
+    kind = COLUMN_FILTERS.get(column.name)
+    if kind == 'range':
+        # the cached frames hold the formatted strings which sort chronologically
+        start, end = _parse_range(value)
+        mask = column.notna()
+        if start is not None:
+            mask &= column >= start.strftime(TIMESTAMP_FORMAT['python'])
+        if end is not None:
+            mask &= column < end.strftime(TIMESTAMP_FORMAT['python'])
+        return mask.fillna(False).astype(bool)
+    elif kind == 'exact':
+        return column == value
+    return _search_mask(column.fillna('').astype(str).str.lower(), value)
 
-    if not df.empty:
-        df_filtered = df_filtered.sort_values(by=by, ascending=ascending,
-                                              key=lambda x: x.str.lower())
-    df_filtered = df_filtered.fillna('')
+
+def _page_rows(page: pd.DataFrame, icmap: dict) -> list:
+    # the rows of the page (keyed by column index) built straight from its columns
+    keys = [str(icmap[c]) for c in page.columns]
+    columns = [page[c].astype(object).where(page[c].notna(), '').tolist()
+               for c in page.columns]
+    return [dict(zip(keys, row)) for row in zip(*columns)]
+
+
+def fetch_frame(params: dict):
+    ftype, start, length = params['ftype'], params['start'], params['length']
+    cmap = COLUMN_MAPS[ftype]
+    icmap = {v: k for k, v in cmap.items()}
+
+    df = get_value(f"vkey.{params['uploads_id']}.{ftype}")
+    # NOTE: reset_index copies the (whole) frame so it's only done when the positions
+    #       don't already match the index, which is normally the case for the frames
+    #       cached by index_frame
+    if not df.index.equals(pd.RangeIndex(df.shape[0])):
+        df = df.reset_index(drop=True)
+    # frames cached before the search column was added compute it here instead
+    searchable = (df[SEARCH_COLUMN] if SEARCH_COLUMN in df.columns
+                  else _search_text(df, cmap))
+    search_value = params['search']
+    masks = [_column_mask(df[cmap[cidx]], v)
+             for cidx, v in params['column_search'].items() if cidx in cmap.keys()]
+    if search_value.strip() != '':
+        masks.append(_search_mask(searchable, search_value))
+    mask = np.logical_and.reduce([m.to_numpy() for m in masks]) if masks else None
+
+    by = [cmap[cidx] for cidx, _ in params['order']]
+    ascending = [asc for _, asc in params['order']]
+    if len(by) == 1 and f"{ORDER_PREFIX}{by[0]}" in df.columns:
+        # the cached permutation is already ordered so only the filter is applied
+        positions = _ordered_positions(df, by[0], ascending[0])
+        if mask is not None:
+            positions = positions[mask[positions]]
+    else:
+        df_filtered = df if mask is None else df.loc[mask, :]
+        if not df_filtered.empty and by:
+            df_filtered = df_filtered.sort_values(by=by, ascending=ascending,
+                                                  key=lambda x: x.str.lower())
+        positions = df.index.get_indexer(df_filtered.index)
 
     end = start + length if length != -1 else df.shape[0]
-    data = list(
-        df_filtered.iloc[start:end]
-        .rename(columns=icmap)
-        .transpose()
-        .to_dict()
-        .values()
-    )
+    data = _page_rows(df.iloc[positions[start:end]][[v for v in cmap.values()]], icmap)
     response = dict(
-        draw=draw,
+        draw=params['draw'],
         recordsTotal=df.shape[0],
-        recordsFiltered=df_filtered.shape[0],
+        recordsFiltered=len(positions),
+        data=data,
+    )
+    return response
+
+
+def _search_expression(sq, cmap: dict):
+    # the text searched, i.e. all the displayed columns separated by spaces
+    columns = []
+    for k, v in cmap.items():
+        if k >= 100:
+            continue
+        elif v in TIMESTAMP_COLUMNS:
+            columns.append(func.to_char(func.to_timestamp(sq.c[v]),
+                                        TIMESTAMP_FORMAT['sql']))
+        else:
+            columns.append(sq.c[v])
+    return func.concat_ws(' ', *columns)
+
+
+def _ilike_clauses(expression, search_value: str) -> list:
+    # every space separated term must be found (case-insensitively) in `expression`
+    clauses = []
+    for term in search_value.split(' '):
+        if term == '':
+            continue
+        clauses.append(expression.ilike(f"%{escape_like(term)}%", escape='\\'))
+    return clauses
+
+
+def _search_clauses(sq, cmap: dict, search_value: str) -> list:
+    # the tables with a search vector use the (indexed) full-text search instead, along
+    # with the displayed columns it doesn't cover (i.e. the level, owner and dates)
+    if 'search_vector' in sq.c.keys():
+        others = {k: v for k, v in cmap.items() if v not in VECTOR_COLUMNS}
+        return full_text_clauses(sq.c['search_vector'], sq.c['filename'], search_value,
+                                 _search_expression(sq, others))
+    return _ilike_clauses(_search_expression(sq, cmap), search_value)
+
+
+def _column_clauses(sq, cmap: dict, column_search: dict) -> list:
+    clauses = []
+    for cidx, value in column_search.items():
+        if cidx not in cmap.keys():
+            continue
+        column = sq.c[cmap[cidx]]
+        kind = COLUMN_FILTERS.get(cmap[cidx])
+        if kind == 'range' and cmap[cidx] in TIMESTAMP_COLUMNS:
+            start, end = _parse_range(value)
+            if start is not None:
+                clauses.append(column >= int(start.timestamp()))
+            if end is not None:
+                clauses.append(column < int(end.timestamp()))
+        elif kind == 'exact':
+            clauses.append(column == value)
+        else:
+            clauses += _ilike_clauses(column, value)
+    return clauses
+
+
+def _order_clauses(sq, cmap: dict, order: list) -> list:
+    clauses = []
+    for cidx, asc in order:
+        column = cmap[cidx]
+        c = sq.c[column] if column in TIMESTAMP_COLUMNS else func.lower(sq.c[column])
+        clauses.append((c.asc() if asc else c.desc()).nulls_last())
+    # the id makes the order (and therefore the pages) deterministic
+    clauses.append(sq.c['id'].asc())
+    return clauses
+
+
+def fetch_sql(params: dict):
+    ftype, start, length = params['ftype'], params['start'], params['length']
+    cmap = COLUMN_MAPS[ftype]
+    icmap = {v: k for k, v in cmap.items()}
+
+    sq = SQL_STATEMENTS[ftype]().subquery()
+    where = (_search_clauses(sq, cmap, params['search']) +
+             _column_clauses(sq, cmap, params['column_search']))
+    records_total = get_total(ftype)
+    if records_total is None or not where:
+        records_total = query_first(select(func.count()).select_from(sq))
+        set_total(ftype, records_total, TOTAL_EXPIRY)
+    if where:
+        records_filtered = query_first(
+            select(func.count()).select_from(sq).where(and_(*where))
+        )
+    else:
+        records_filtered = records_total
+
+    stmt = (
+        select(*[sq.c[v] for v in cmap.values()])
+        .where(*where)
+        .order_by(*_order_clauses(sq, cmap, params['order']))
+        .offset(start)
+    )
+    if length != -1:
+        stmt = stmt.limit(length)
+    df = query_df(stmt)
+    for column in TIMESTAMP_COLUMNS:
+        if column in df.columns:
+            df[column] = df[column].apply(
+                lambda x: x if pd.isna(x) else
+                dt.datetime.fromtimestamp(x).strftime(TIMESTAMP_FORMAT['python'])
+            )
+    data = _page_rows(df, icmap)
+    response = dict(
+        draw=params['draw'],
+        recordsTotal=records_total,
+        recordsFiltered=records_filtered,
         data=data,
     )
     return response
@@ -1,6 +1,6 @@
 from typing import Any, Dict
 from sqlalchemy import insert
-from datams.db.core import query_all
+from datams.db.core import query_all, query_all_scalars
 from datams.db.tables import (Contact, Deployment, DeploymentOrganization, File,
                               Mooring, Organization, Equipment)
 
@@ -43,9 +43,14 @@ def insert_deployment(values: Dict[str, Any]):
 def insert_files(values: Dict[str, Any]):
     paths = values.pop('paths')
     names = values.pop('names')
-    assert len(names) == len(paths)
-    query_all([insert(File).values(path=paths[i], name=names[i], **values)
-               for i in range(len(paths))])
+    checksums = values.pop('checksums', [None] * len(paths))
+    assert len(names) == len(paths) == len(checksums)
+    # return the ids of the new files so the cached processed_files can be patched
+    return query_all_scalars([
+        insert(File).values(path=paths[i], name=names[i], checksum=checksums[i],
+                            **values).returning(File.id)
+        for i in range(len(paths))
+    ])
 
 
 def insert_equipment(values: Dict[str, Any]):
@@ -1,12 +1,16 @@
 import os
+import re
 import datetime as dt
-from pathlib import Path
 import pandas as pd
-from sqlalchemy import select, text, func, literal_column, String
+from sqlalchemy import (select, text, func, literal_column, String, case, or_,
+                        tuple_)
 
 from datams.utils import (MENU_CONFIG, TIMEZONES, DISCOVERY_DIRECTORY,
                           PENDING_DIRECTORY)
 from datams.db.core import query_df, query_first_df, query_first
+from datams.db.utils import escape_like
+from datams.discovery import scan, select_discovered
+from datams.walk import walk_files, realpath
 from datams.db.tables import (
     Contact, Country, Deployment, DeploymentContact, DeploymentOrganization, File,
     Equipment, Mooring, MooringEquipment, Organization, User, DeletedFile, FILE_LEVELS
@@ -44,7 +48,7 @@ def select_query(data, **kwargs):
     elif data == 'mfile':
         return select_mfiles(**kwargs)
     elif data == 'processed_files':
-        return select_processed_files()
+        return select_processed_files(**kwargs)
     elif data == 'pending_files':
         return select_pending_files()
     elif data == 'discovered_files':
@@ -94,31 +98,213 @@ def _get_file_level(file_id):
         return 'unowned'
 
 
+def _file_id_filter(**kwargs):
+    if 'file_id' in kwargs:
+        return File.id == kwargs.get('file_id')
+    elif 'file_ids' in kwargs:
+        return File.id.in_(kwargs.get('file_ids'))
+    return None
+
+
 def next_deployment_id():
     stmt = text(f'''SELECT last_value FROM "Deployment_id_seq";''')
     return int(query_first_df(stmt)['last_value'])
 
 
-def select_processed_files():
+def select_processed_files(**kwargs):
+    # NOTE: passing `file_ids` restricts the result to those files, this is used to
+    #       patch the cached frame instead of recomputing it entirely
     df = pd.concat(
-        [select_ufiles(), select_ofiles(), select_dfiles(), select_mfiles()]
+        [select_ufiles(**kwargs), select_ofiles(**kwargs), select_dfiles(**kwargs),
+         select_mfiles(**kwargs)]
     ).reset_index(drop=True)
     df = df[['id', 'level', 'filename', 'owner', 'description', 'uploaded',
              'url', 'path']]
     return df.rename(columns={'path': 'filepath'})
 
 
+# NOTE: The following statements produce the same columns as select_processed_files and
+#       select_deleted_files but entirely in sql (with `uploaded` and `deleted` left as
+#       timestamps), they are used to filter, order and page the file tables in the
+#       database (see datams.db.datatables.fetch_sql)
+def _filename_expression(table):
+    # sql equivalent of the `filename` computed by file_format and deleted_file_format
+    # NOTE: rendered with literals so that it matches the expression of the trigram
+    #       index (see INDEX_DDL in datams.db.tables)
+    return func.coalesce(table.name, func.regexp_replace(
+        table.path, literal_column("'^.*/'"), literal_column("''")
+    ))
+
+
+def _deployment_organizations(deployment_id):
+    return (
+        select(func.string_agg(Organization.abbreviation.distinct(),
+                               literal_column("', '")))
+        .join_from(DeploymentOrganization, Organization)
+        .where(DeploymentOrganization.deployment_id == deployment_id)
+        .scalar_subquery()
+    )
+
+
+def _deployment_owner():
+    deployed = (select(func.min(Mooring.deployed))
+                .where(Mooring.deployment_id == Deployment.id)
+                .scalar_subquery())
+    return (
+        select(func.concat(
+            '[', _deployment_organizations(Deployment.id), '] ', Deployment.region,
+            ', ', Country.name, ' -- ',
+            func.to_char(func.to_timestamp(deployed), 'YYYY-MM-DD')))
+        .join_from(Deployment, Country)
+        .where(Deployment.id == File.deployment_id)
+        .scalar_subquery()
+    )
+
+
+def _mooring_equipment_owner():
+    time_format = 'MonDD-YYYY@HH24:MI:SS'
+    return (
+        select(func.concat(
+            '[', _deployment_organizations(Deployment.id), '] ', Deployment.region,
+            ', ', Country.name, ' -- [',
+            func.to_char(func.to_timestamp(Mooring.deployed), time_format), ' to ',
+            func.to_char(func.to_timestamp(Mooring.recovered), time_format),
+            '] -- [Lat: ', Mooring.latitude, ' Lon: ', Mooring.longitude, ']'))
+        .join_from(MooringEquipment, Mooring, MooringEquipment.mooring_id == Mooring.id)
+        .join_from(Mooring, Deployment, Mooring.deployment_id == Deployment.id)
+        .join_from(Deployment, Country, Deployment.country_id == Country.id)
+        .where(MooringEquipment.id == File.mooring_equipment_id)
+        .scalar_subquery()
+    )
+
+
+def processed_files_statement():
+    # NOTE: rendered with literals so that it matches the expression of the index
+    #       ordering by the level (see LEVEL in datams.db.tables)
+    level = case(
+        (File.mooring_equipment_id != None, literal_column("'Mooring Equipment'")),
+        (File.deployment_id != None, literal_column("'Deployment'")),
+        (File.organization_id != None, literal_column("'Organization'")),
+        else_=literal_column("'Unowned'")
+    )
+    owner = case(
+        (File.mooring_equipment_id != None, _mooring_equipment_owner()),
+        (File.deployment_id != None, _deployment_owner()),
+        (File.organization_id != None,
+         select(Organization.abbreviation)
+         .where(Organization.id == File.organization_id)
+         .scalar_subquery()),
+        else_=''
+    )
+    return select(
+        File.id, level.label('level'), _filename_expression(File).label('filename'),
+        owner.label('owner'), File.description, File.uploaded,
+        func.concat('/file/details?index=', File.id).label('url'), File.search_vector
+    )
+
+
+def deleted_files_statement():
+    return select(
+        DeletedFile.id, DeletedFile.original_id, DeletedFile.ftype,
+        _filename_expression(DeletedFile).label('filename'), DeletedFile.description,
+        DeletedFile.uploaded, DeletedFile.deleted, DeletedFile.search_vector
+    )
+
+
+def _tsquery(search_value: str):
+    # prefix match every word of `search_value`, i.e. `foo bar` -> `foo:* & bar:*`
+    words = re.findall(r'\w+', search_value)
+    if not words:
+        return None
+    return func.to_tsquery('simple', ' & '.join([f"{w}:*" for w in words]))
+
+
+def full_text_clauses(search_vector, filename, search_value: str,
+                      others=None) -> list:
+    # Every space separated term must either match the words of the search vector (by
+    # prefix) or be part of the filename, both of which are indexed (see INDEX_DDL in
+    # datams.db.tables), or else be part of the (unindexed) text `others`.
+    clauses = []
+    for term in search_value.split(' '):
+        if term == '':
+            continue
+        partial = filename.ilike(f"%{escape_like(term)}%", escape='\\')
+        if others is not None:
+            partial = or_(partial, others.ilike(f"%{escape_like(term)}%", escape='\\'))
+        query = _tsquery(term)
+        clauses.append(partial if query is None
+                       else or_(search_vector.op('@@')(query), partial))
+    return clauses
+
+
+def search_files(search_value: str, deleted: bool = False, limit: int = 50):
+    # full-text search of the processed (or deleted) files ordered by relevance
+    table = DeletedFile if deleted else File
+    filename = _filename_expression(table)
+    clauses = full_text_clauses(table.search_vector, filename, search_value)
+    if not clauses:
+        return pd.DataFrame(columns=['id', 'filename', 'description', 'uploaded',
+                                     'rank'])
+    query = _tsquery(search_value)
+    rank = (literal_column('0') if query is None
+            else func.ts_rank(table.search_vector, query))
+    stmt = (
+        select(table.id, filename.label('filename'), table.description,
+               table.uploaded, rank.label('rank'))
+        .where(*clauses)
+        .order_by(rank.desc(), table.id.desc())
+        .limit(limit)
+    )
+    df = query_df(stmt)
+    df['uploaded'] = df['uploaded'].apply(
+        lambda x: x if pd.isna(x) else
+        dt.datetime.fromtimestamp(x).strftime('%Y-%m-%d %H:%M:%S')
+    )
+    return df
+
+
+# column: sql expression, the columns the processed files can be listed by (each has a
+# covering index on (column, id), see datams.db.tables.File)
+LIST_ORDERS = dict(
+    uploaded=File.uploaded,
+    filename=_filename_expression(File),
+    id=File.id,
+)
+
+
+def list_files(order_by: str = 'uploaded', ascending: bool = True, after: tuple = None,
+               limit: int = 100):
+    """
+    keyset paginated listing of the processed files ordered by (`order_by`, id),
+    `after` is the (`order_by` value, id) of the last file of the previous page
+    """
+    column = LIST_ORDERS[order_by]
+    keys = (column,) if order_by == 'id' else (column, File.id)
+    stmt = (
+        select(File.id, _filename_expression(File).label('filename'),
+               File.description, File.uploaded)
+        .order_by(*[k.asc() if ascending else k.desc() for k in keys])
+        .limit(limit)
+    )
+    if after is not None:
+        after = after[-len(keys):]
+        stmt = stmt.where(tuple_(*keys) > tuple_(*after) if ascending
+                          else tuple_(*keys) < tuple_(*after))
+    return query_df(stmt)
+
+
 def select_pending_files():
-    deleted = list(select_deleted_files()['path'].apply(
+    deleted = set(select_deleted_files()['path'].apply(
         lambda x: x if x is None else os.path.realpath(x))
     )
-    t = [f for f in Path(PENDING_DIRECTORY).rglob('*')
-         if f.is_file() and not os.path.basename(str(f)).startswith('.temp')]
     filepaths, filenames, uploaded, uploaded_bys = [], [], [], []
-    for i in range(len(t)):
+    for entry in walk_files(PENDING_DIRECTORY):
         # TODO: Consider using a regular expression to validate the filename
-        c_filepath, f = str(t[i]), os.path.basename(str(t[i]))
-        if os.path.realpath(c_filepath) not in deleted:
+        c_filepath, f = entry.path, entry.name
+        # the uploads in progress (see datams.uploads) and any other hidden file
+        if f.startswith('.'):
+            continue
+        if realpath(entry) not in deleted:
             try:
                 c_filename = '.'.join(f.split('.')[2:])
                 c_uploaded = dt.datetime.fromtimestamp(
@@ -138,31 +324,14 @@ def select_pending_files():
 
 
 def select_discovered_files():
-    """
-    p = pathlib.Path('/First/Second/Third/Fourth/Fifth')
-    p.parts[2:]
-    ('Second', 'Third', 'Fourth', 'Fifth')
-    pathlib.Path(*p.parts[2:])
-    PosixPath('Second/Third/Fourth/Fifth')
-
-    """
-    touched_files = []
-    normal_files = set([
-        str(f) if not str(f).endswith('.touch') else touched_files.append(str(f)[:-6])
-        for f in Path(DISCOVERY_DIRECTORY).rglob('*')
-        if f.is_file()
-    ])
-    if None in normal_files:
-        normal_files.remove(None)
-    filepaths = sorted(list(normal_files.difference(touched_files)))
-    # log.debug(len(Path(DISCOVERY_DIRECTORY).parts))
-    filenames = [
-        str(Path(*Path(f).parts[len(Path(DISCOVERY_DIRECTORY).parts):]))
-        for f in filepaths
-    ]
+    # NOTE: only the directories that changed since the last scan are listed (see
+    #       datams.discovery)
+    scan(DISCOVERY_DIRECTORY)
+    df = select_discovered()
+    filepaths = list(df['path'])
+    filenames = [os.path.relpath(f, DISCOVERY_DIRECTORY) for f in filepaths]
     last_modifies = [
-        dt.datetime.fromtimestamp(os.path.getmtime(f)).strftime('%Y-%m-%d %H:%M:%S')
-        for f in filepaths
+        dt.datetime.fromtimestamp(m).strftime('%Y-%m-%d %H:%M:%S') for m in df['mtime']
     ]
     return pd.DataFrame({'id': [i for i in range(len(filepaths))],
                          'filepath': filepaths, 'filename': filenames,
@@ -480,7 +649,7 @@ def select_equipment(view=None, **kwargs):
 
 def select_ufiles(view=None, **kwargs):
     v = 'None' if view is None else view
-    fid = None if 'file_id' not in kwargs else File.id == kwargs.get('file_id')
+    fid = _file_id_filter(**kwargs)
     query_def = {
         # 'view': (columns, where)
         'None':
@@ -507,7 +676,7 @@ def select_ufiles(view=None, **kwargs):
 
 def select_ofiles(view=None, **kwargs):
     v = 'None' if view is None else view
-    fid = None if 'file_id' not in kwargs else File.id == kwargs.get('file_id')
+    fid = _file_id_filter(**kwargs)
     query_def = {
         # 'view': (columns, where)
         'None':
@@ -537,7 +706,7 @@ def select_ofiles(view=None, **kwargs):
 
 def select_dfiles(view=None, **kwargs):
     v = 'None' if view is None else view
-    fid = None if 'file_id' not in kwargs else File.id == kwargs.get('file_id')
+    fid = _file_id_filter(**kwargs)
     query_def = {
         # 'view': (columns, where)
         'None':
@@ -574,7 +743,7 @@ def select_dfiles(view=None, **kwargs):
 
 def select_mfiles(view=None, **kwargs):
     v = 'None' if view is None else view
-    fid = None if 'file_id' not in kwargs else File.id == kwargs.get('file_id')
+    fid = _file_id_filter(**kwargs)
     query_def = {
         # 'view': (columns, where)
         'None':
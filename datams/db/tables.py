@@ -1,11 +1,59 @@
 from typing import Optional, Set
-from sqlalchemy import ForeignKey, String
+from sqlalchemy import ForeignKey, String, Computed, Index, BigInteger, text
+from sqlalchemy.dialects.postgresql import TSVECTOR
+from sqlalchemy.schema import CreateIndex
 from sqlalchemy.orm import DeclarativeBase, Mapped
 from sqlalchemy.orm import mapped_column, relationship, validates
 from flask_login import UserMixin
 from datams.db.utils import connect_and_return_engine
 
 FILE_LEVELS = ['organization', 'deployment', 'mooring_equipment', 'unowned']
+# seen: listed as a discovered file, processed: added as a File, ignored: hidden
+DISCOVERED_STATES = ['seen', 'processed', 'ignored']
+
+# the filename shown for a File/DeletedFile (see datams.db.formatting.file_format)
+FILENAME = "coalesce(name, regexp_replace(path, '^.*/', ''))"
+# the level shown for a File (see datams.db.queries.select.processed_files_statement)
+LEVEL = (
+    "CASE WHEN mooring_equipment_id IS NOT NULL THEN 'Mooring Equipment' "
+    "WHEN deployment_id IS NOT NULL THEN 'Deployment' "
+    "WHEN organization_id IS NOT NULL THEN 'Organization' ELSE 'Unowned' END"
+)
+# the words of the filename, description and comments of a File/DeletedFile used by the
+# full-text search (see datams.db.queries.select.search_files)
+SEARCH_VECTOR = (
+    "to_tsvector('simple', coalesce(name, '') || ' ' || "
+    "regexp_replace(path, '^.*/', '') || ' ' || coalesce(description, '') || ' ' || "
+    "coalesce(comments, ''))"
+)
+# NOTE: The tables (along with the indexes declared on them) are only created by
+#       create_all when they don't exist yet, the columns added since are added to
+#       existing tables by COLUMN_DDL and the indexes that can't be declared with the
+#       models by INDEX_DDL, see migrate_db.
+# The search vector is kept up to date by postgres (as a generated column) and indexed
+# along with the filename (using trigrams to also match partial names).
+COLUMN_DDL = ["CREATE EXTENSION IF NOT EXISTS pg_trgm"] + [
+    statement for table in ['File', 'DeletedFile'] for statement in [
+        f'ALTER TABLE "{table}" ADD COLUMN IF NOT EXISTS search_vector tsvector '
+        f'GENERATED ALWAYS AS ({SEARCH_VECTOR}) STORED',
+        f'ALTER TABLE "{table}" ADD COLUMN IF NOT EXISTS checksum VARCHAR(100)',
+    ]
+]
+INDEX_DDL = {
+    name: statement for table in ['File', 'DeletedFile'] for name, statement in [
+        (f"ix_{table}_search_vector",
+         f'CREATE INDEX CONCURRENTLY IF NOT EXISTS "ix_{table}_search_vector" '
+         f'ON "{table}" USING gin (search_vector)'),
+        (f"ix_{table}_filename_trgm",
+         f'CREATE INDEX CONCURRENTLY IF NOT EXISTS "ix_{table}_filename_trgm" '
+         f'ON "{table}" USING gin (({FILENAME}) gin_trgm_ops)'),
+    ]
+}
+# the indexes left invalid by a concurrent build that failed (i.e. was interrupted)
+INVALID_INDEXES = (
+    "SELECT c.relname FROM pg_index i JOIN pg_class c ON c.oid = i.indexrelid "
+    "WHERE NOT i.indisvalid"
+)
 
 # TODO: Need to make some choices on how to deal with foreign keys of deleted records
 # TODO: Add validations (i.e. like constraints on what a valid timestamps is or how an
@@ -85,6 +133,11 @@ class Deployment(Base):
 
 class DeletedFile(Base):
     __tablename__ = 'DeletedFile'
+    __table_args__ = (
+        # matches the default order of the deleted files table (see
+        # datams.db.datatables.fetch_sql)
+        Index('ix_DeletedFile_lower_filename_id', text(f"lower({FILENAME})"), 'id'),
+    )
 
     id: Mapped[int] = mapped_column(primary_key=True, autoincrement=True)
     original_id: Mapped[int]
@@ -96,9 +149,13 @@ class DeletedFile(Base):
     path: Mapped[str]
     name: Mapped[Optional[str]]
     description: Mapped[Optional[str]]
-    uploaded: Mapped[int]
-    deleted: Mapped[int]
+    uploaded: Mapped[int] = mapped_column(index=True)
+    deleted: Mapped[int] = mapped_column(index=True)
     comments: Mapped[Optional[str]]
+    checksum: Mapped[Optional[str]] = mapped_column(String(100))
+    search_vector: Mapped[Optional[str]] = mapped_column(
+        TSVECTOR, Computed(SEARCH_VECTOR, persisted=True), deferred=True
+    )
 
 
 class DeploymentContact(Base):
@@ -123,26 +180,66 @@ class DeploymentOrganization(Base):
     )
 
 
+# NOTE: DiscoveredDirectory and DiscoveredFile are the manifest of the discovery
+#       directory maintained by datams.discovery.scan
+class DiscoveredDirectory(Base):
+    __tablename__ = 'DiscoveredDirectory'
+
+    path: Mapped[str] = mapped_column(primary_key=True)
+    parent: Mapped[Optional[str]] = mapped_column(index=True)
+    # -1 when the directory has to be listed again by the next scan
+    mtime_ns: Mapped[int] = mapped_column(BigInteger)
+
+
+class DiscoveredFile(Base):
+    __tablename__ = 'DiscoveredFile'
+
+    path: Mapped[str] = mapped_column(primary_key=True)
+    directory: Mapped[str] = mapped_column(index=True)
+    size: Mapped[int] = mapped_column(BigInteger)
+    mtime: Mapped[float]
+    inode: Mapped[int] = mapped_column(BigInteger)
+    state: Mapped[str] = mapped_column(String(10), default='seen',
+                                       server_default='seen', index=True)
+
+
 # TODO: Add condition that File can have no foreign keys or one foreign key
 class File(Base):
     __tablename__ = 'File'
+    __table_args__ = (
+        # covering indexes for the keyset pagination (see select.list_files)
+        Index('ix_File_uploaded_id', 'uploaded', 'id',
+              postgresql_include=['name', 'path', 'description']),
+        Index('ix_File_filename_id', text(FILENAME), 'id',
+              postgresql_include=['name', 'path', 'description', 'uploaded']),
+        # match the (lowercased) orders of the processed files table, by default on
+        # the level (see datams.db.datatables.fetch_sql)
+        Index('ix_File_lower_level_id', text(f"lower({LEVEL})"), 'id'),
+        Index('ix_File_lower_filename_id', text(f"lower({FILENAME})"), 'id'),
+    )
 
     id: Mapped[int] = mapped_column(primary_key=True, autoincrement=True)
     organization_id: Mapped[int] = mapped_column(
-        ForeignKey('Organization.id', ondelete='SET NULL'), nullable=True
+        ForeignKey('Organization.id', ondelete='SET NULL'), nullable=True, index=True
     )
     deployment_id: Mapped[int] = mapped_column(
-        ForeignKey('Deployment.id', ondelete='SET NULL'), nullable=True
+        ForeignKey('Deployment.id', ondelete='SET NULL'), nullable=True, index=True
     )
     mooring_equipment_id: Mapped[int] = mapped_column(
-        ForeignKey('MooringEquipment.id', ondelete='SET NULL'), nullable=True
+        ForeignKey('MooringEquipment.id', ondelete='SET NULL'), nullable=True,
+        index=True
     )
 
-    path: Mapped[str]
+    path: Mapped[str] = mapped_column(index=True)
     name: Mapped[Optional[str]]
     description: Mapped[str]
     uploaded: Mapped[int]
     comments: Mapped[Optional[str]]
+    # of uploaded files only (see datams.uploads.upload_checksum)
+    checksum: Mapped[Optional[str]] = mapped_column(String(100), index=True)
+    search_vector: Mapped[Optional[str]] = mapped_column(
+        TSVECTOR, Computed(SEARCH_VECTOR, persisted=True), deferred=True
+    )
 
 
 class Equipment(Base):
@@ -171,7 +268,8 @@ class Mooring(Base):
 
     id: Mapped[int] = mapped_column(primary_key=True, autoincrement=True)
     deployment_id: Mapped[int] = mapped_column(ForeignKey('Deployment.id',
-                                                          ondelete='CASCADE'))
+                                                          ondelete='CASCADE'),
+                                               index=True)
     deployed: Mapped[int]
     recovered: Mapped[Optional[int]]
     timezone: Mapped[Optional[float]]
@@ -244,9 +342,46 @@ def wipe_db(app_config):
 def initialize_db(app_config):
     engine = connect_and_return_engine(app_config)
     Base.metadata.drop_all(engine)
-    Base.metadata.create_all(engine)
+    migrate_db(app_config)
 
 
 def sync_table_models(app_config):
+    # NOTE: called every time the app starts so only creates the missing tables, an
+    #       existing database is brought up to date by migrate_db (see the migrate-db
+    #       command)
+    engine = connect_and_return_engine(app_config)
+    Base.metadata.create_all(engine)
+
+
+def _create_index_concurrently(index: Index, dialect) -> str:
+    # the ddl of the declared `index` built without locking out the writes to its table
+    index.dialect_options['postgresql']['concurrently'] = True
+    try:
+        return str(CreateIndex(index, if_not_exists=True).compile(dialect=dialect))
+    finally:
+        index.dialect_options['postgresql']['concurrently'] = False
+
+
+def migrate_db(app_config):
+    """
+    Add the columns and indexes missing from the existing tables.  The indexes are
+    built concurrently (i.e. while the app keeps running) which can't be done within a
+    transaction so each statement is committed on its own.
+    """
     engine = connect_and_return_engine(app_config)
     Base.metadata.create_all(engine)
+    with engine.begin() as connection:
+        for statement in COLUMN_DDL:
+            connection.execute(text(statement))
+
+    statements = dict(INDEX_DDL)
+    for table in Base.metadata.sorted_tables:
+        for index in table.indexes:
+            statements[index.name] = _create_index_concurrently(index, engine.dialect)
+    with engine.connect().execution_options(isolation_level='AUTOCOMMIT') as connection:
+        # an invalid index would otherwise be skipped by IF NOT EXISTS
+        for name in connection.execute(text(INVALID_INDEXES)).scalars():
+            if name in statements.keys():
+                connection.execute(text(f'DROP INDEX CONCURRENTLY "{name}"'))
+        for statement in statements.values():
+            connection.execute(text(statement))
@@ -3,6 +3,7 @@ from typing import Tuple
 import pandas as pd
 from math import floor, log, cos, pi
 from sqlalchemy import create_engine
+from datams.redis import reserve_name, release_name
 
 DIRECTORY_LIMIT = 65000
 
@@ -20,44 +21,53 @@ class MissingRequiredDataError(Exception):
         super().__init__(self.message)
 
 
-def resolve_filename(filename, directory):
-    i = 0
-    new_filename = filename
-    while new_filename in os.listdir(directory):
-        fl = filename.split('.')
-        new_filename = (f"{'.'.join(fl[:-1])} ({i}).{fl[-1]}"
-                        if len(fl) > 1 else f"{filename} ({i})")
-        i += 1
-    return new_filename
+def escape_like(value: str, escape: str = '\\') -> str:
+    # escape the wildcards of a (I)LIKE pattern
+    for i in [escape, '%', '_']:
+        value = value.replace(i, f"{escape}{i}")
+    return value
 
 
 def is_int_directory(directory):
     try:
         int(directory)
-    except TypeError:
+    except (TypeError, ValueError):
         return False
     return True
 
 
-def check_directory_fullness(root_dir, cdir_idx, cdir_count):
+def _index_shards(root_dir):
+    # the current (i.e. highest numbered) shard of `root_dir` and the names within it
+    int_dirs = [int(i) for i in os.listdir(root_dir)
+                if is_int_directory(i) and os.path.isdir(f"{root_dir}/{i}")]
+    cdir_idx = max(int_dirs) if int_dirs else 0
     cdir = f"{root_dir}/{cdir_idx}"
-    while cdir_count >= DIRECTORY_LIMIT:
-        cdir_idx += 1
+    os.makedirs(cdir, exist_ok=True)
+    return cdir_idx, os.listdir(cdir)
+
+
+def allocate_path(root_dir, filename):
+    """
+    Reserve a unique path for `filename` within the current shard (a subdirectory
+    holding at most DIRECTORY_LIMIT entries) of `root_dir`.  The names are reserved in
+    redis so this is safe across workers and never lists the shard (except once to
+    index it).
+    """
+    while True:
+        cdir_idx, name = reserve_name(root_dir, filename, DIRECTORY_LIMIT,
+                                      _index_shards)
         cdir = f"{root_dir}/{cdir_idx}"
         os.makedirs(cdir, exist_ok=True)
-        cdir_count = len(os.listdir(cdir))
-    return cdir, cdir_idx, cdir_count
+        # NOTE: files added to the shard by anything else aren't indexed
+        if not os.path.lexists(f"{cdir}/{name}"):
+            return f"{cdir}/{name}"
 
 
-def resolve_directory(root_dir):
-    int_dirs = [i for i in os.listdir(root_dir)
-                if os.path.isdir(f"{root_dir}/{i}") and is_int_directory(i)]
-    cdir_idx = max(int_dirs) if int_dirs else 0
-    cdir = f"{root_dir}/{cdir_idx}"
-    if not int_dirs:
-        os.makedirs(cdir, exist_ok=True)
-    cdir_count = len(os.listdir(cdir))
-    return check_directory_fullness(root_dir, cdir_idx, cdir_count)
+def release_path(root_dir, path):
+    # free the name of `path` (allocated by allocate_path) once it is moved or removed
+    cdir, name = os.path.split(path)
+    if os.path.dirname(cdir) == root_dir and is_int_directory(os.path.basename(cdir)):
+        release_name(root_dir, int(os.path.basename(cdir)), name)
 
 
 def create_upload_directories(path):
@@ -91,6 +101,18 @@ def result_to_df(result):
     return pd.DataFrame(result, columns=result.keys())
 
 
+def patch_df(df: pd.DataFrame, rows: pd.DataFrame, ids, on='id') -> pd.DataFrame:
+    """
+    Replace the rows of `df` whose `on` value is in `ids` with `rows`.  Any of the ids
+    that are missing from `rows` (i.e. deleted) are simply dropped from `df`.
+    """
+    df = df.loc[~df[on].isin(ids), :]
+    rows = rows.reindex(columns=df.columns)
+    if rows.empty:
+        return df.reset_index(drop=True)
+    return pd.concat([df, rows]).reset_index(drop=True)
+
+
 def map_properties(moorings: pd.DataFrame) -> Tuple[Tuple[float, float], float]:
     m = moorings.copy().loc[:, ['latitude', 'longitude']].dropna()
     if m.empty:
@@ -0,0 +1,192 @@
+import os
+import time
+import pandas as pd
+from sqlalchemy import select, delete, update, exists
+from sqlalchemy.dialects.postgresql import insert
+
+from datams.utils import DISCOVERY_DIRECTORY
+from datams.redis import lock
+from datams.walk import walk
+from datams.db.core import query_df, query_all
+from datams.db.tables import (DiscoveredDirectory, DiscoveredFile, File,
+                               DISCOVERED_STATES)
+
+try:
+    from inotify_simple import INotify, flags
+except ImportError:  # inotify_simple is optional and only required by `watch`
+    INotify = flags = None
+
+"""
+Incremental scanner of the discovery directory.
+
+The scan keeps a manifest of every directory (with its mtime) and file (with its size,
+mtime and inode) in the DiscoveredDirectory and DiscoveredFile tables.  Adding, removing
+or renaming an entry changes the mtime of its directory so only the directories whose
+mtime changed since the last scan are listed again, the rest are only stat'ed to find
+out that they didn't change.  Directories are stat'ed and listed in parallel (see
+datams.walk).
+
+The state of each discovered file (see DISCOVERED_STATES) is kept in the manifest as
+well.  The `<file>.touch` files previously created to mark a file as processed are
+still recognized, they are left out of the manifest and mark their file as processed.
+
+NOTE: modifying the content of a file doesn't change the mtime of its directory, so the
+      size and mtime of a file are only updated when its directory is listed again.
+"""
+
+# directories modified within this many seconds of the start of a scan are listed again
+# by the next scan as they might change again within the same mtime tick
+MTIME_GRACE = 2
+# number of rows upserted per statement
+UPSERT_BATCH = 1000
+
+
+def _upsert(table, rows: list, index: str, columns: list) -> list:
+    statements = []
+    for i in range(0, len(rows), UPSERT_BATCH):
+        stmt = insert(table).values(rows[i:i + UPSERT_BATCH])
+        statements.append(stmt.on_conflict_do_update(
+            index_elements=[index], set_={c: stmt.excluded[c] for c in columns}
+        ))
+    return statements
+
+
+def _list_directory(directory: str) -> tuple:
+    files, subdirectories, touched = [], [], []
+    with os.scandir(directory) as it:
+        for entry in it:
+            try:
+                if entry.is_dir(follow_symlinks=False):
+                    subdirectories.append(entry.path)
+                elif entry.name.endswith('.touch'):
+                    touched.append(entry.path[:-6])
+                elif entry.is_file():
+                    stat = entry.stat()
+                    files.append(dict(path=entry.path, directory=directory,
+                                      size=stat.st_size, mtime=stat.st_mtime,
+                                      inode=stat.st_ino))
+            except OSError:  # removed while listing
+                continue
+    return files, subdirectories, touched
+
+
+def scan(root: str = DISCOVERY_DIRECTORY) -> int:
+    """
+    update the manifest of the discovery directory returning the number of directories
+    that had to be listed
+    """
+    with lock('discovery_scan'):
+        return _scan(root)
+
+
+def _scan(root: str) -> int:
+    df = query_df(select(DiscoveredDirectory.path, DiscoveredDirectory.parent,
+                         DiscoveredDirectory.mtime_ns))
+    known = dict(zip(df['path'], df['mtime_ns']))
+    children = (df.groupby('parent')['path'].apply(list).to_dict()
+                if not df.empty else {})
+    threshold = time.time_ns() - MTIME_GRACE * 1_000_000_000
+
+    def visit(directory):
+        try:
+            mtime_ns = os.stat(directory).st_mtime_ns
+            if known.get(directory) == mtime_ns:  # unchanged, only check its children
+                return (directory, None), children.get(directory, [])
+            listing = _list_directory(directory)
+        # removed while scanning or unreadable, either way it is dropped from the
+        # manifest like a removed directory
+        except (FileNotFoundError, NotADirectoryError, PermissionError):
+            return None, []
+        return (directory, (mtime_ns,) + listing), listing[1]
+
+    statements, directories, files, touched, seen, listed = [], [], [], [], set(), 0
+    for result in walk([root], visit):
+        if result is None:
+            continue
+        directory, listing = result
+        seen.add(directory)
+        if listing is None:
+            continue
+        mtime_ns, c_files, _, c_touched = listing
+        listed += 1
+        directories.append(dict(
+            path=directory, mtime_ns=mtime_ns if mtime_ns < threshold else -1,
+            parent=None if directory == root else os.path.dirname(directory)
+        ))
+        files += c_files
+        touched += c_touched
+        statements.append(
+            delete(DiscoveredFile)
+            .where(DiscoveredFile.directory == directory)
+            .where(DiscoveredFile.path.not_in([f['path'] for f in c_files]))
+        )
+
+    removed = list(set(known.keys()).difference(seen))
+    if removed:
+        statements += [
+            delete(DiscoveredFile).where(DiscoveredFile.directory.in_(removed)),
+            delete(DiscoveredDirectory).where(DiscoveredDirectory.path.in_(removed)),
+        ]
+    statements += _upsert(DiscoveredDirectory, directories, 'path',
+                          ['parent', 'mtime_ns'])
+    statements += _upsert(DiscoveredFile, files, 'path',
+                          ['directory', 'size', 'mtime', 'inode'])
+    if touched:
+        statements.append(update(DiscoveredFile).values(state='processed')
+                          .where(DiscoveredFile.path.in_(touched)))
+    if statements:
+        query_all(statements)
+    return listed
+
+
+def select_discovered() -> pd.DataFrame:
+    # the files that are neither processed (as a File) nor ignored
+    return query_df(
+        select(DiscoveredFile.path, DiscoveredFile.mtime)
+        .where(DiscoveredFile.state == 'seen')
+        .where(~exists().where(File.path == DiscoveredFile.path))
+        .order_by(DiscoveredFile.path)
+    )
+
+
+def set_discovered_state(paths: list, state: str):
+    if state not in DISCOVERED_STATES:
+        raise ValueError(f"Unknown discovered state: `{state}`")
+    if paths:
+        query_all([update(DiscoveredFile).values(state=state)
+                   .where(DiscoveredFile.path.in_(paths))])
+
+
+def watch(on_change, root: str = DISCOVERY_DIRECTORY, delay: float = 1.0):
+    """
+    Calls `on_change` whenever something is added, removed or renamed anywhere within
+    `root` (i.e. to refresh the discovered files which scans the changes).  Events
+    arriving within `delay` seconds of each other are handled together.  Requires the
+    optional inotify_simple package (linux only).
+    """
+    if INotify is None:
+        raise RuntimeError("Watching the discovery directory requires `inotify_simple` "
+                           "to be installed.  ")
+    inotify = INotify()
+    mask = (flags.CREATE | flags.DELETE | flags.MOVED_FROM | flags.MOVED_TO |
+            flags.DELETE_SELF)
+    watches = dict()
+
+    def add_watches(directory):
+        for path, _, _ in os.walk(directory):
+            try:
+                watches[inotify.add_watch(path, mask)] = path
+            except FileNotFoundError:
+                continue
+
+    add_watches(root)
+    on_change()
+    while True:
+        events = inotify.read(read_delay=int(delay * 1000))
+        for event in events:
+            created = event.mask & (flags.CREATE | flags.MOVED_TO)
+            if event.mask & flags.ISDIR and created:
+                add_watches(os.path.join(watches[event.wd], event.name))
+            elif event.mask & flags.IGNORED:
+                watches.pop(event.wd, None)
+        on_change()
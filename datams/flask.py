@@ -17,14 +17,19 @@ def flask_init_app(name, test_config=None):
 
     # 3) register the command-line scripts
     from datams.cli import (
-        wipe_db_command, init_db_command, resolve_files_command, create_user_command,
-        delete_user_command
+        wipe_db_command, init_db_command, migrate_db_command, resolve_files_command,
+        create_user_command, delete_user_command, watch_discoveries_command,
+        unignore_files_command, serve_metrics_command
     )
     app.cli.add_command(wipe_db_command)  # register the wipe-db command
     app.cli.add_command(init_db_command)  # register the init-db command
+    app.cli.add_command(migrate_db_command)  # register the migrate-db command
     app.cli.add_command(resolve_files_command)  # ...
     app.cli.add_command(create_user_command)
     app.cli.add_command(delete_user_command)
+    app.cli.add_command(watch_discoveries_command)
+    app.cli.add_command(unignore_files_command)
+    app.cli.add_command(serve_metrics_command)
 
     # 4) add callbacks connected to application signals
     @app.before_request
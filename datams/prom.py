@@ -229,5 +229,64 @@ def createInfo(name,desc):
     return Info(_ensureValid(name), 'Info {}'.format(desc), registry=pom_registry)
 
 
-
-    
\ No newline at end of file
+# NOTE: Each process (web workers, celery workers and their children, commands) only
+#       writes its metrics to the files of the shared directory `multiproc_dir` (see
+#       the PROMETHEUS section of the config) which are aggregated and served by the
+#       serve-metrics command alone, see serveMultiprocess.
+REDIS_POOL_STATS = ['max_connections', 'created', 'in_use', 'idle']
+_redis_pool_gauges = None
+
+
+def initRedisPoolGauges():
+    # the utilisation of the redis connection pools (see datams.redis), labelled by
+    # pool and (in multiprocess mode) by the pid of the live processes
+    global _redis_pool_gauges
+    if _redis_pool_gauges is None:
+        _redis_pool_gauges = {
+            stat: Gauge(f"redis_pool_{stat}", f"Gauge redis connection pool {stat}",
+                        ['pool'], multiprocess_mode='liveall')
+            for stat in REDIS_POOL_STATS
+        }
+
+
+def updateRedisPoolGauges():
+    from datams.redis import pool_stats
+    if _redis_pool_gauges is not None:
+        for pool, values in pool_stats().items():
+            for stat, gauge in _redis_pool_gauges.items():
+                gauge.labels(pool).set(values[stat])
+
+
+def markProcessDead(pid):
+    # drops the live gauges of `pid` from the shared directory
+    from prometheus_client import multiprocess
+    multiprocess.mark_process_dead(pid)
+
+
+def serveMultiprocess(port):
+    # serves the metrics of all the processes until interrupted
+    from wsgiref.simple_server import make_server
+    from prometheus_client import CollectorRegistry, multiprocess
+    registry = CollectorRegistry()
+    multiprocess.MultiProcessCollector(registry)
+    httpd = make_server('', port, make_wsgi_app(registry), ThreadingWSGIServer,
+                        handler_class=_SilentHandler)
+    httpd.serve_forever()
+
+
+def prom_init_app(app):
+    # sample the redis pools after every request and celery task
+    import atexit
+    from celery.signals import task_postrun, worker_process_shutdown
+    initRedisPoolGauges()
+
+    @app.after_request
+    def update_redis_pool_gauges(response):
+        updateRedisPoolGauges()
+        return response
+
+    task_postrun.connect(lambda **_: updateRedisPoolGauges(), weak=False)
+    # NOTE: the children of the celery workers exit without running atexit
+    worker_process_shutdown.connect(lambda **_: markProcessDead(os.getpid()),
+                                    weak=False)
+    atexit.register(lambda: markProcessDead(os.getpid()))
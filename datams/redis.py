@@ -1,34 +1,57 @@
-from io import StringIO
 import pandas as pd
 from flask import Flask, current_app, g
-from redis import Redis
+from redis import Redis, BlockingConnectionPool
 from typing import Any
-from datams.utils import APP_CONFIG
-import datetime as dt
+from datams.utils import APP_CONFIG, REMOVE_STALES_EVERY
+from datams.serialization import decode_df, CACHE_CONFIG
+import re
+import uuid
 import time
+import datetime as dt
+import contextlib
 import functools
+import os
 
 
-# interval between attempts to acquire lock
-RETRY_INTERVAL = dict(checkins=0.05, default=0.05)  # seconds
 # should only be relevant thread crashes
-LOCK_EXPIRY = dict(checkins=10, default=60)  # seconds
+# the frame keys are locked for the whole of their (re)computation (see datams.celery)
+# although only by the one worker running it, the others leave their requests to it
+LOCK_EXPIRY = dict(default=60, discovery_scan=3600, processed_files=600,  # seconds
+                   pending_files=600, discovered_files=3600, deleted_files=600)
+# number of decoded DataFrames each worker process keeps in memory
+LOCAL_CACHE_SIZE = CACHE_CONFIG.get('local_size', 16)
+# the optional `REDIS_POOL` section of the config file configures the connection pools
+# shared by every client of a process (see get_pool)
+POOL_CONFIG = APP_CONFIG.get('REDIS_POOL', {})
+POOL_SIZE = POOL_CONFIG.get('max_connections', 32)
+POOL_TIMEOUT = POOL_CONFIG.get('timeout', 20)  # seconds to wait for a free connection
+POOL_KEEPALIVE = POOL_CONFIG.get('socket_keepalive', True)
+POOL_HEALTH_CHECK_INTERVAL = POOL_CONFIG.get('health_check_interval', 30)  # seconds
+
+
+# the lock is only deleted by its owner and when it is the waiting workers are woken up
+# by pushing onto the `<key>_lock_signal` list (which they are blocked on with BLPOP)
+# KEYS: lock, signal  ARGV: owner token, signal expiry (ms)
+RELEASE_LOCK = """
+if redis.call('GET', KEYS[1]) ~= ARGV[1] then
+    return 0
+end
+redis.call('DEL', KEYS[1], KEYS[2])
+redis.call('RPUSH', KEYS[2], 1)
+redis.call('PEXPIRE', KEYS[2], ARGV[2])
+return 1
+"""
 
 
 # NOTE: not the first argument of any methods decorated by this method should be `key`
 #       this determines which lock to use
-# TODO: Implement the locking in a better more robust manner
-# TODO: Implement require lock to be used with the `with` statement to ensure the lock
-#       is released
 # TODO: Add ability to have multiple locks, but beware of dead-locking
 def requires_lock(_func=None, *, unused_arg=None):
     def decorator_requires_lock(func):
         @functools.wraps(func)
         def wrapper_requires_lock(key, *args, **kwargs):
-            acquire_lock(key)
-            retval = func(key, *args, **kwargs)
-            release_lock(key)
-            return retval
+            with lock(key):
+                return func(key, *args, **kwargs)
         return wrapper_requires_lock
     if _func is None:
         return decorator_requires_lock
@@ -36,16 +59,61 @@ def requires_lock(_func=None, *, unused_arg=None):
         return decorator_requires_lock(_func)
 
 
-def get_redis(app: Flask = None) -> Redis:
+# NOTE: the binary client doesn't decode responses and is used to read the encoded
+#       DataFrames (see datams.serialization)
+def get_redis(app: Flask = None, binary: bool = False) -> Redis:
+    name = 'redis_binary' if binary else 'redis'
     try:
         if app is None:
-            if 'redis' not in g:
-                g.redis = current_app.extensions['redis']
-            return g.redis
+            if name not in g:
+                setattr(g, name, current_app.extensions[name])
+            return getattr(g, name)
         else:
-            return app.extensions['redis']
+            return app.extensions[name]
     except RuntimeError:
-        return Redis(**APP_CONFIG['REDIS'])
+        # outside of the app context (i.e. cli commands) the client is cheap since the
+        # connections come from the shared pool
+        return Redis(connection_pool=get_pool(binary))
+
+
+def _redis_config(binary: bool = False) -> dict:
+    config = dict(APP_CONFIG['REDIS'])
+    if binary:
+        config['decode_responses'] = False
+    return config
+
+
+# binary: (pid, pool)
+_POOLS = dict()
+
+
+def get_pool(binary: bool = False) -> BlockingConnectionPool:
+    # One pool per process for each type of client.  A forked child (i.e. the celery
+    # prefork workers) must not share the sockets of its parent so it creates its own.
+    pid, pool = _POOLS.get(binary, (None, None))
+    if pid != os.getpid():
+        config = _redis_config(binary)
+        config.setdefault('socket_keepalive', POOL_KEEPALIVE)
+        config.setdefault('health_check_interval', POOL_HEALTH_CHECK_INTERVAL)
+        pool = BlockingConnectionPool(max_connections=POOL_SIZE, timeout=POOL_TIMEOUT,
+                                      **config)
+        _POOLS[binary] = (os.getpid(), pool)
+    return pool
+
+
+def pool_stats() -> dict:
+    # utilization of the connection pools of the current process
+    stats = dict()
+    for binary, (pid, pool) in _POOLS.items():
+        if pid != os.getpid():
+            continue
+        created = len(pool._connections)
+        idle = len([c for c in list(pool.pool.queue) if c is not None])
+        stats['redis_binary' if binary else 'redis'] = dict(
+            max_connections=pool.max_connections, created=created,
+            in_use=created - idle, idle=idle
+        )
+    return stats
 
 
 def is_locked(key: str):
@@ -60,105 +128,562 @@ def is_working(key: str):
     return True if redis.exists(f"{key}_working") == 1 else False
 
 
-def set_working(key: str):
+# NOTE: set_working and set_finished accept any number of keys (and set_working any
+#       `changes`, the ids of the rows of a key to patch rather than recompute, to
+#       publish) and do all of it in one round trip
+def set_working(*keys: str, changes: dict = None):
     redis = get_redis()
-    redis.set(f"{key}_working", 'y')
+    pipe = redis.pipeline()
+    for key in keys:
+        if key.startswith('vkey.'):
+            # tracked with (and expiring like) the vkeys themselves
+            pipe.set(f"{key}_working", 'y', px=VKEY_EXPIRY * 1000)
+            pipe.sadd(_vkeys_key(key), f"{key}_working")
+        else:
+            pipe.set(f"{key}_working", 'y')
+    for key, ids in ({} if changes is None else changes).items():
+        if ids:
+            pipe.sadd(f"{key}_changes", *ids)
+    pipe.execute()
     return
 
 
-def set_finished(key: str):
-    delete_key(f"{key}_working")
+def set_finished(*keys: str):
+    # also publishes each key on its `ready.<key>` channel (see listen_ready)
+    redis = get_redis()
+    pipe = redis.pipeline()
+    if keys:
+        pipe.delete(*[f"{key}_working" for key in keys])
+    for key in keys:
+        pipe.publish(f"ready.{key}", key)
+    pipe.execute()
     return
 
 
-def acquire_lock(key: str):
-    retry_interval = RETRY_INTERVAL.get(key, RETRY_INTERVAL['default'])
+def await_root(root_key: str, vkey: str, rebuild: bool = False) -> bool:
+    # Have `vkey` reference the snapshot of `root_key` once the root is finished (see
+    # finish_root).  Returns False, and doesn't wait, if the root isn't working unless
+    # `rebuild` in which case the root is marked as working (to be rebuilt by the
+    # caller) along with it.
+    redis = get_redis()
+    pipe = redis.pipeline()
+    if rebuild:
+        pipe.set(f"{root_key}_working", 'y')
+    pipe.sadd(f"{root_key}_awaiting", vkey)
+    pipe.exists(f"{root_key}_working")
+    *_, working = pipe.execute()
+    if working == 0:
+        redis.srem(f"{root_key}_awaiting", vkey)
+    return working == 1
+
+
+def finish_root(key: str):
+    # set_finished for a root key that also references the snapshot just written for
+    # the vkeys awaiting it
+    # NOTE: `<key>_working` is deleted before the awaiting vkeys are read so a vkey is
+    #       either read here or sees that the root isn't working (see await_root)
+    redis = get_redis()
+    pipe = redis.pipeline()
+    pipe.delete(f"{key}_working")
+    pipe.smembers(f"{key}_awaiting")
+    pipe.delete(f"{key}_awaiting")
+    pipe.publish(f"ready.{key}", key)
+    _, vkeys, _, _ = pipe.execute()
+    for vkey in vkeys:
+        reference_snapshot(vkey)
+    set_finished(*vkeys)
+
+
+def listen_ready(keys: list, timeout: float, keepalive: float):
+    # Yields each of the `keys` that is ready (immediately for those that aren't
+    # working) or becomes ready within `timeout` seconds.  None is yielded after every
+    # `keepalive` seconds without an event so the caller can keep the connection alive.
+    redis = get_redis()
+    pubsub = redis.pubsub(ignore_subscribe_messages=True)
+    # subscribe before checking so that an event in between isn't missed
+    pubsub.subscribe(*[f"ready.{key}" for key in keys])
+    try:
+        pipe = redis.pipeline()
+        for key in keys:
+            pipe.exists(f"{key}_working")
+        for key, working in zip(keys, pipe.execute()):
+            if working == 0:
+                yield key
+        deadline = time.monotonic() + timeout
+        remaining = timeout
+        while remaining > 0:
+            message = pubsub.get_message(timeout=min(remaining, keepalive))
+            yield None if message is None else message['data']
+            remaining = deadline - time.monotonic()
+    finally:
+        pubsub.close()
+
+
+@contextlib.contextmanager
+def lock(key: str):
+    token = acquire_lock(key)
+    try:
+        yield token
+    finally:
+        release_lock(key, token)
+
+
+def acquire_lock(key: str) -> str:
+    # returns the owner token required to release the lock
     lock_expiry = LOCK_EXPIRY.get(key, LOCK_EXPIRY['default'])
     redis = get_redis()
-    while True:
-        locked = True if redis.exists(f"{key}_lock") == 1 else False
-        if locked:
-            time.sleep(retry_interval)
-        else:
-            # 1. set the lock
-            redis.set(f"{key}_lock", 'y', dt.timedelta(seconds=lock_expiry))
-            break
-    return
+    token = uuid.uuid4().hex
+    while not redis.set(f"{key}_lock", token, nx=True, px=lock_expiry * 1000):
+        # block until the owner releases the lock or at the latest until it expires
+        ttl = redis.pttl(f"{key}_lock")
+        if ttl == -2:  # released in the meantime
+            continue
+        timeout = lock_expiry if ttl < 0 else max(ttl / 1000, 0.01)
+        redis.blpop([f"{key}_lock_signal"], timeout=timeout)
+    return token
 
 
-def release_lock(key: str):
-    delete_key(f"{key}_lock")
+def try_acquire_lock(key: str):
+    # like acquire_lock but returns None rather than waiting when the lock is taken
+    lock_expiry = LOCK_EXPIRY.get(key, LOCK_EXPIRY['default'])
+    token = uuid.uuid4().hex
+    if get_redis().set(f"{key}_lock", token, nx=True, px=lock_expiry * 1000):
+        return token
+    return None
 
 
-def delete_key(key: str):
+def release_lock(key: str, token: str) -> bool:
+    # returns False if the lock had already expired (and possibly been taken by another)
+    lock_expiry = LOCK_EXPIRY.get(key, LOCK_EXPIRY['default'])
     redis = get_redis()
-    if redis.exists(key) == 1:
-        redis.delete(key)
+    script = redis.register_script(RELEASE_LOCK)
+    released = script(keys=[f"{key}_lock", f"{key}_lock_signal"],
+                      args=[token, lock_expiry * 1000])
+    return released == 1
+
+
+def delete_key(*keys: str):
+    # deleting a key that doesn't exist is a no-op so no need to check first
+    redis = get_redis()
+    if keys:
+        redis.delete(*keys)
     return
 
 
+# NOTE: a rebuild of a root key is requested by setting `<key>_rebuild` and its patches
+#       by adding the changed ids to `<key>_changes` (see set_working), whichever
+#       worker holds the lock of the key runs all of them (see
+#       datams.celery.refresh_root)
+def request_rebuild(key: str):
+    get_redis().set(f"{key}_rebuild", 'y')
+
+
+def pop_rebuild(key: str) -> bool:
+    # whether a rebuild of `key` was requested, the request is then cleared
+    return get_redis().delete(f"{key}_rebuild") == 1
+
+
+def has_requests(key: str) -> bool:
+    redis = get_redis()
+    pipe = redis.pipeline()
+    pipe.exists(f"{key}_rebuild")
+    pipe.exists(f"{key}_changes")
+    return any(pipe.execute())
+
+
+def pop_changes(key: str) -> list:
+    # atomically fetch and clear the ids published for `key`
+    redis = get_redis()
+    pipe = redis.pipeline()
+    pipe.smembers(f"{key}_changes")
+    pipe.delete(f"{key}_changes")
+    ids, _ = pipe.execute()
+    return [int(i) for i in ids]
+
+
+# NOTE: The cached DataFrames are stored as immutable snapshots
+#       `snapshot.<root_key>.<generation>`.  The generation is a random token rather
+#       than a counter so it is never reused (i.e. after redis is flushed or restarted
+#       without persistence) which would serve stale frames from the workers' local
+#       caches (see _get_decoded).  The root's current generation is stored
+#       in `<root_key>_generation` and a vkey (i.e. `vkey.<uploads_id>.<root_key>`)
+#       simply holds the generation of the snapshot it references.  The references
+#       to each generation are counted in the hash `<root_key>_references` and a
+#       snapshot is dropped once it is neither current nor referenced.  All of this
+#       bookkeeping is done within lua scripts so that it is atomic.
+#
+#       The vkeys of each uploads_id are tracked in the set `vkeys.<uploads_id>` which
+#       is used to remove them once the uploads_id stops checking in.  As a safety net
+#       the vkeys, these sets and the snapshots that are no longer current expire after
+#       VKEY_EXPIRY unless they are refreshed by a check-in.
+FRAME_KEYS = ['processed_files', 'pending_files', 'discovered_files', 'deleted_files']
+VKEY_EXPIRY = max(REMOVE_STALES_EVERY * 4, 60)  # seconds
+
+# NOTE: a vkey that doesn't hold a generation (i.e. `^%x+$` of at most 32 characters)
+#       is a legacy full copy of its root
+# KEYS: generation, references, legacy root value
+# ARGV: snapshot prefix, payload, expiry (ms), new generation
+WRITE_SNAPSHOT = """
+local old = redis.call('GET', KEYS[1])
+local gen = ARGV[4]
+redis.call('SET', KEYS[1], gen)
+redis.call('SET', ARGV[1] .. gen, ARGV[2])
+redis.call('DEL', KEYS[3])
+if old then
+    if tonumber(redis.call('HGET', KEYS[2], old) or '0') <= 0 then
+        redis.call('HDEL', KEYS[2], old)
+        redis.call('DEL', ARGV[1] .. old)
+    else
+        redis.call('PEXPIRE', ARGV[1] .. old, ARGV[3])
+    end
+end
+-- forget the references of snapshots that have expired
+for _, g in ipairs(redis.call('HKEYS', KEYS[2])) do
+    if redis.call('EXISTS', ARGV[1] .. g) == 0 then
+        redis.call('HDEL', KEYS[2], g)
+    end
+end
+return gen
+"""
+
+# a root value written by a previous version (i.e. during a rollout) becomes the first
+# snapshot of the root unless it already has one
+# KEYS: generation, legacy root value  ARGV: snapshot prefix, new generation
+SEED_SNAPSHOT = """
+local gen = redis.call('GET', KEYS[1])
+if gen then
+    return gen
+end
+local value = redis.call('GET', KEYS[2])
+if not value then
+    return false
+end
+redis.call('SET', ARGV[1] .. ARGV[2], value)
+redis.call('SET', KEYS[1], ARGV[2])
+redis.call('DEL', KEYS[2])
+return ARGV[2]
+"""
+
+# KEYS: generation, references, vkey, vkeys of the uploads_id
+# ARGV: snapshot prefix, expiry (ms)
+REFERENCE_SNAPSHOT = """
+local gen = redis.call('GET', KEYS[1])
+if not gen then
+    return false
+end
+redis.call('SADD', KEYS[4], KEYS[3])
+redis.call('PEXPIRE', KEYS[4], ARGV[2])
+local old = redis.call('GET', KEYS[3])
+if old == gen then
+    redis.call('PEXPIRE', KEYS[3], ARGV[2])
+    return gen
+end
+redis.call('HINCRBY', KEYS[2], gen, 1)
+redis.call('SET', KEYS[3], gen, 'PX', ARGV[2])
+if old and string.len(old) <= 32 and string.match(old, '^%x+$') and
+        redis.call('HINCRBY', KEYS[2], old, -1) <= 0 then
+    redis.call('HDEL', KEYS[2], old)
+    redis.call('DEL', ARGV[1] .. old)
+end
+return gen
+"""
+
+# KEYS: generation, references, vkey, vkeys of the uploads_id  ARGV: snapshot prefix
+RELEASE_SNAPSHOT = """
+local old = redis.call('GET', KEYS[3])
+redis.call('DEL', KEYS[3])
+redis.call('SREM', KEYS[4], KEYS[3])
+if old and string.len(old) <= 32 and string.match(old, '^%x+$') and
+        redis.call('HINCRBY', KEYS[2], old, -1) <= 0 then
+    redis.call('HDEL', KEYS[2], old)
+    if old ~= redis.call('GET', KEYS[1]) then
+        redis.call('DEL', ARGV[1] .. old)
+    end
+end
+return old
+"""
+
+# refresh the expiry of the vkeys of an uploads_id and of the snapshots they reference
+# KEYS: vkeys of the uploads_id  ARGV: expiry (ms)
+TOUCH_VKEYS = """
+for _, vkey in ipairs(redis.call('SMEMBERS', KEYS[1])) do
+    redis.call('PEXPIRE', vkey, ARGV[1])
+    local root = string.match(vkey, '^vkey%.[^.]+%.[^.]+%.(.+)$')
+    local gen = redis.call('GET', vkey)
+    if root and gen and gen ~= redis.call('GET', root .. '_generation') then
+        redis.call('PEXPIRE', 'snapshot.' .. root .. '.' .. gen, ARGV[1])
+    end
+end
+redis.call('PEXPIRE', KEYS[1], ARGV[1])
+"""
+
+
+def _snapshot_keys(root_key: str) -> list:
+    return [f"{root_key}_generation", f"{root_key}_references", f"snapshot.{root_key}."]
+
+
+def _root_key(key: str) -> str:
+    return '.'.join(key.split('.')[3:]) if key.startswith('vkey.') else key
+
+
+def _vkeys_key(key: str) -> str:
+    # the set of vkeys belonging to the uploads_id of vkey `key`
+    return f"vkeys.{'.'.join(key.split('.')[1:3])}"
+
+
 @requires_lock
 def set_value(key, value) -> None:
     # locking is preformed within the celery tasks that call this method
     # it is assumed that caller has acquired the lock before calling this method
+    write_value(key, value)
+
+
+def _is_generation(value: str) -> bool:
+    return re.fullmatch(r'[0-9a-f]{1,32}', value) is not None
+
+
+def write_value(key, value) -> str:
+    # NOTE: the caller must already hold the lock on `key` (a root key).  The value is
+    #       written as a new snapshot so the local caches of the workers and the vkeys
+    #       referencing older snapshots are unaffected.
     redis = get_redis()
-    redis.set(key, value)
+    generation, references, prefix = _snapshot_keys(key)
+    script = redis.register_script(WRITE_SNAPSHOT)
+    return script(keys=[generation, references, key],
+                  args=[prefix, value, VKEY_EXPIRY * 1000, uuid.uuid4().hex])
 
 
-def get_value(key: str) -> Any:
+def seed_snapshot(key: str):
+    # returns the generation of the root `key` seeded from its legacy value (decoded
+    # by decode_df like any snapshot) or None if it has neither
+    redis = get_redis()
+    generation, _, prefix = _snapshot_keys(key)
+    script = redis.register_script(SEED_SNAPSHOT)
+    return script(keys=[generation, key], args=[prefix, uuid.uuid4().hex])
+
+
+def reference_snapshot(vkey: str):
+    # point `vkey` at the current snapshot of its root, this is O(1) regardless of
+    # the size of the snapshot.  Returns None if the root hasn't been computed yet
     redis = get_redis()
+    root_key = _root_key(vkey)
+    generation, references, prefix = _snapshot_keys(root_key)
+    script = redis.register_script(REFERENCE_SNAPSHOT)
+    keys = [generation, references, vkey, _vkeys_key(vkey)]
+    args = [prefix, VKEY_EXPIRY * 1000]
+    value = script(keys=keys, args=args)
+    if value is None and seed_snapshot(root_key) is not None:
+        value = script(keys=keys, args=args)
+    return value
+
+
+def release_snapshot(vkey: str) -> None:
+    redis = get_redis()
+    generation, references, prefix = _snapshot_keys(_root_key(vkey))
+    script = redis.register_script(RELEASE_SNAPSHOT)
+    script(keys=[generation, references, vkey, _vkeys_key(vkey)], args=[prefix])
+
+
+def _snapshot_generation(key: str):
+    # return the generation of the snapshot referenced by `key` or None if there is none
+    redis = get_redis()
+    if not key.startswith('vkey.'):
+        generation = redis.get(f"{key}_generation") or seed_snapshot(key)
+    else:
+        generation = redis.get(key)
+        if generation is None or not _is_generation(generation):
+            # new vkey (or a legacy full copy) so reference the current snapshot
+            generation = reference_snapshot(key)
+    return generation
+
+
+@functools.lru_cache(maxsize=LOCAL_CACHE_SIZE)
+def _get_decoded(root_key: str, generation: str):
+    # snapshots are immutable so entries never need invalidating and simply age out
+    value = get_redis(binary=True).get(f"snapshot.{root_key}.{generation}")
+    return None if value is None else decode_df(value)
+
+
+def get_value(key: str) -> Any:
+    redis = get_redis(binary=True)
     key_conversion_default = dict(
         processed_files=(
-            lambda x: pd.read_json(StringIO(x)),
+            decode_df,
             pd.DataFrame(columns=['id', 'level', 'owner', 'description', 'filename',
                                   'uploaded', 'url'])
         ),
         pending_files=(
-            lambda x: pd.read_json(StringIO(x)),
+            decode_df,
             pd.DataFrame(columns=['id', 'filename', 'uploaded', 'uploaded_by'])
         ),
         discovered_files=(
-            lambda x: pd.read_json(StringIO(x)),
+            decode_df,
             pd.DataFrame(columns=['id', 'filename', 'last_modified'])
         ),
         deleted_files=(
-            lambda x: pd.read_json(StringIO(x)),
+            decode_df,
             pd.DataFrame(columns=['id', 'filename', 'description', 'uploaded',
                                   'deleted', 'original_id', 'ftype'])
         ),
-        checkins=(eval, []),
     )
-    is_vkey = False
-    if key.startswith('vkey.'):
-        is_vkey = True
-        root_key = '.'.join(key.split('.')[3:])
-    else:
-        root_key = key
+    root_key = _root_key(key)
     if root_key not in key_conversion_default.keys():
         raise RuntimeError(f"Attempting to get unknown key: `{root_key}`")
     conversion, default = key_conversion_default[root_key]
+    if conversion is decode_df:
+        # a hit costs a single GET of the generation and no decoding
+        generation = _snapshot_generation(key)
+        df = None if generation is None else _get_decoded(root_key, generation)
+        if df is None and key.startswith('vkey.') and generation is not None:
+            # the referenced snapshot expired so reference the current one instead
+            generation = reference_snapshot(key)
+            df = None if generation is None else _get_decoded(root_key, generation)
+        return default if df is None else df.copy(deep=False)
     value = redis.get(key)
-    if is_vkey and value is None:
-        root_value = redis.get(root_key)
-        root_value = default.to_json() if root_value is None else root_value
-        set_value(key, root_value)
-        value = root_value
     return default if value is None else conversion(value)
 
 
-# TODO: Consider expanding this concept to any variables we want to freeze for a view so
-#       that removing these would simply entail looking for a specific key prefix and
-#       seeing if the uploads_id is valid rather than explicitly listing each type.
-def remove_stale_vkeys(valid_uids):
+# NOTE: the check-ins are kept in the sorted set `checkins` of uploads_ids scored by the
+#       timestamp of their latest check-in so no locking is required
+def add_checkin(uploads_id: str, timestamp: float) -> None:
+    # also refreshes the expiry of the vkeys of the uploads_id
     redis = get_redis()
-    delete = [k for k in redis.scan_iter("vkey.*")
-              if '.'.join(k.split('.')[1:3]) not in valid_uids]
-    current_app.logger.debug(['.'.join(k.split('.')[1:3]) for k in delete])
-    for k in delete:
-        redis.delete(k)
+    script = redis.register_script(TOUCH_VKEYS)
+    pipe = redis.pipeline()
+    pipe.zadd('checkins', {uploads_id: timestamp})
+    script(keys=[f"vkeys.{uploads_id}"], args=[VKEY_EXPIRY * 1000], client=pipe)
+    pipe.execute()
+
+
+def get_valid_checkins() -> list:
+    # return the (uploads_id, timestamp) of the check-ins that haven't yet expired
+    redis = get_redis()
+    expired = dt.datetime.now().timestamp() - REMOVE_STALES_EVERY
+    return redis.zrangebyscore('checkins', f"({expired}", '+inf', withscores=True)
+
+
+def pop_stale_checkins() -> list:
+    # remove the expired check-ins and return their uploads_ids
+    redis = get_redis()
+    expired = dt.datetime.now().timestamp() - REMOVE_STALES_EVERY
+    pipe = redis.pipeline()
+    pipe.zrangebyscore('checkins', '-inf', expired)
+    pipe.zremrangebyscore('checkins', '-inf', expired)
+    stale_uids, _ = pipe.execute()
+    return stale_uids
+
+
+def remove_stale_vkeys(stale_uids):
+    # NOTE: this is proportional to the number of stale uploads_ids, any vkeys missed
+    #       (i.e. an uploads_id that never checked in) simply expire
+    redis = get_redis()
+    current_app.logger.debug(stale_uids)
+    for uid in stale_uids:
+        for k in redis.smembers(f"vkeys.{uid}"):
+            if _root_key(k) in FRAME_KEYS:
+                release_snapshot(k)
+            else:
+                redis.delete(k)
+        redis.delete(f"vkeys.{uid}")
+
+
+# NOTE: the uploaded files are sharded into numbered subdirectories of their root
+#       directory (see datams.db.utils.allocate_path).  The number of the current shard
+#       of a root is kept in `shards.<root>` and the names within it in the set
+#       `shards.<root>.<shard>` so a name is reserved without listing the directory.
+# KEYS: current shard  ARGV: shard prefix, shard limit, name, stem, extension
+RESERVE_NAME = """
+local shard = tonumber(redis.call('GET', KEYS[1]))
+if not shard then
+    return false
+end
+while redis.call('SCARD', ARGV[1] .. shard) >= tonumber(ARGV[2]) do
+    redis.call('DEL', ARGV[1] .. shard)
+    shard = shard + 1
+    redis.call('SET', KEYS[1], shard)
+end
+local name, i = ARGV[3], 0
+while redis.call('SISMEMBER', ARGV[1] .. shard, name) == 1 do
+    name = ARGV[4] .. ' (' .. i .. ')' .. ARGV[5]
+    i = i + 1
+end
+redis.call('SADD', ARGV[1] .. shard, name)
+return {shard, name}
+"""
+SHARD_BATCH = 10000  # names added per command when indexing a shard
+
+
+def reserve_name(root: str, name: str, limit: int, index) -> tuple:
+    """
+    Atomically reserve `name`, or the first free `<stem> (i).<extension>`, within the
+    current shard of `root` moving on to the next shard once it holds `limit` names.
+    The first reservation of a root calls `index(root)` for the `(shard, names)` of its
+    current shard.  Returns the `(shard, name)` reserved.
+    """
+    redis = get_redis()
+    script = redis.register_script(RESERVE_NAME)
+    fl = name.split('.')
+    stem, extension = (('.'.join(fl[:-1]), f".{fl[-1]}") if len(fl) > 1
+                       else (name, ''))
+    keys = [f"shards.{root}"]
+    args = [f"shards.{root}.", limit, name, stem, extension]
+    reserved = script(keys=keys, args=args)
+    if reserved is None:
+        with lock(f"shards.{root}"):
+            if not redis.exists(keys[0]):
+                shard, names = index(root)
+                pipe = redis.pipeline()
+                pipe.delete(f"shards.{root}.{shard}")
+                for i in range(0, len(names), SHARD_BATCH):
+                    pipe.sadd(f"shards.{root}.{shard}", *names[i:i + SHARD_BATCH])
+                pipe.set(keys[0], shard)
+                pipe.execute()
+        reserved = script(keys=keys, args=args)
+    shard, name = reserved
+    return int(shard), name
+
+
+def release_name(root: str, shard: int, name: str) -> None:
+    # free a name reserved within (or moved out of) a shard of `root`
+    get_redis().srem(f"shards.{root}.{shard}", name)
+
+
+# NOTE: the checksums of the uploaded files (see datams.uploads) are kept in the hash
+#       `checksums` by the path of their pending file until they are processed
+def set_checksums(checksums: dict) -> None:
+    if checksums:
+        get_redis().hset('checksums', mapping=checksums)
+
+
+def pop_checksums(paths: list) -> list:
+    # the checksums (or None) of `paths` which are then forgotten
+    if not paths:
+        return []
+    redis = get_redis()
+    pipe = redis.pipeline()
+    pipe.hmget('checksums', paths)
+    pipe.hdel('checksums', *paths)
+    checksums, _ = pipe.execute()
+    return checksums
+
+
+# NOTE: the total number of records of the tables fetched from the database (see
+#       datams.db.datatables.fetch_sql) are kept for a few seconds so that they aren't
+#       counted again on every draw
+def get_total(ftype: str):
+    total = get_redis().get(f"total.{ftype}")
+    return None if total is None else int(total)
+
+
+def set_total(ftype: str, total: int, expiry: int) -> None:
+    get_redis().set(f"total.{ftype}", total, ex=expiry)
 
 
 def redis_init_app(app: Flask) -> Redis:
-    redis = Redis(**app.config['REDIS'])
+    redis = Redis(connection_pool=get_pool())
     app.extensions['redis'] = redis
+    # the check-ins used to be stored as a string representation of a list
+    if redis.type('checkins') == 'string':
+        redis.delete('checkins')
+    app.extensions['redis_binary'] = Redis(connection_pool=get_pool(binary=True))
     return redis
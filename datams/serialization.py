@@ -0,0 +1,131 @@
+import json
+import struct
+from io import BytesIO, StringIO
+import pandas as pd
+from datams.utils import APP_CONFIG
+
+try:
+    import pyarrow as pa
+    import pyarrow.ipc  # noqa: F401
+except ImportError:  # pyarrow is optional, fall back to json without it
+    pa = None
+
+try:
+    import orjson
+except ImportError:  # orjson is optional, fall back to the standard library without it
+    orjson = None
+
+"""
+Codecs used to store pandas DataFrames in redis.
+
+Every encoded payload starts with a small header:
+    MAGIC (4 bytes) | VERSION (1 byte) | CODEC_ID (1 byte)
+followed by the codec specific body.  Payloads without the header are assumed to be
+the plain `DataFrame.to_json()` strings written by previous versions so that they can
+still be read during a rollout.
+
+The codec and compression are configured with the optional `CACHE` section of the
+config file:
+    CACHE:
+      codec: arrow  # arrow, parquet or json
+      compression: zstd  # zstd, lz4 or null (ignored by json)
+"""
+
+MAGIC = b'DTMS'
+VERSION = 1
+HEADER = struct.Struct('4sBB')
+
+CACHE_CONFIG = APP_CONFIG.get('CACHE', {})
+CODEC = CACHE_CONFIG.get('codec', 'json' if pa is None else 'arrow')
+COMPRESSION = CACHE_CONFIG.get('compression')
+
+
+def _json_encode(df: pd.DataFrame, compression=None) -> bytes:
+    return df.to_json().encode('utf-8')
+
+
+def _json_decode(body: bytes) -> pd.DataFrame:
+    return pd.read_json(StringIO(body.decode('utf-8')))
+
+
+def _arrow_encode(df: pd.DataFrame, compression=None) -> bytes:
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    options = pa.ipc.IpcWriteOptions(compression=compression)
+    sink = pa.BufferOutputStream()
+    with pa.ipc.new_stream(sink, table.schema, options=options) as writer:
+        writer.write_table(table)
+    return sink.getvalue().to_pybytes()
+
+
+def _arrow_decode(body: bytes) -> pd.DataFrame:
+    return pa.ipc.open_stream(body).read_pandas()
+
+
+def _parquet_encode(df: pd.DataFrame, compression=None) -> bytes:
+    buffer = BytesIO()
+    df.to_parquet(buffer, engine='pyarrow', index=False,
+                  compression='none' if compression is None else compression)
+    return buffer.getvalue()
+
+
+def _parquet_decode(body: bytes) -> pd.DataFrame:
+    return pd.read_parquet(BytesIO(body), engine='pyarrow')
+
+
+# codec_name: (codec_id, encode, decode)
+CODECS = dict(
+    json=(0, _json_encode, _json_decode),
+    arrow=(1, _arrow_encode, _arrow_decode),
+    parquet=(2, _parquet_encode, _parquet_decode),
+)
+CODEC_IDS = {v[0]: k for k, v in CODECS.items()}
+
+
+def encode_df(df: pd.DataFrame, codec: str = None) -> bytes:
+    codec = CODEC if codec is None else codec
+    if codec not in CODECS.keys():
+        raise RuntimeError(f"Unknown codec: `{codec}`")
+    if codec != 'json' and pa is None:
+        raise RuntimeError(f"Codec: `{codec}` requires pyarrow to be installed.  ")
+    codec_id, encode, _ = CODECS[codec]
+    try:
+        body = encode(df, COMPRESSION)
+    except (TypeError, ValueError):
+        # arrow can't represent some object columns (i.e. mixed types) but json can,
+        # note ArrowInvalid and ArrowTypeError derive from ValueError and TypeError
+        if codec == 'json':
+            raise
+        codec_id, encode, _ = CODECS['json']
+        body = encode(df)
+    return HEADER.pack(MAGIC, VERSION, codec_id) + body
+
+
+def dumps_json(obj) -> bytes:
+    if orjson is not None:
+        return orjson.dumps(obj)
+    return json.dumps(obj, separators=(',', ':')).encode('utf-8')
+
+
+def iter_json(obj: dict, key: str, batch: int = 1000):
+    # Yields the json encoding of `obj` in parts, with the list under `key` encoded
+    # `batch` items at a time so that a large response never exists as a whole.
+    items = obj[key]
+    head = dumps_json({k: v for k, v in obj.items() if k != key})
+    yield head[:-1] + (b',' if len(head) > 2 else b'') + f'"{key}":['.encode('utf-8')
+    for i in range(0, len(items), batch):
+        part = dumps_json(items[i:i + batch])[1:-1]
+        yield part if i == 0 or not part else b',' + part
+    yield b']}'
+
+
+def decode_df(payload) -> pd.DataFrame:
+    if isinstance(payload, str):
+        payload = payload.encode('utf-8')
+    if not payload.startswith(MAGIC):
+        # legacy payload written with `DataFrame.to_json()`
+        return _json_decode(payload)
+    _, version, codec_id = HEADER.unpack_from(payload)
+    if version > VERSION:
+        raise RuntimeError(f"Unsupported cache payload version: `{version}`")
+    _, _, decode = CODECS[CODEC_IDS[codec_id]]
+    return decode(payload[HEADER.size:])
@@ -83,7 +83,81 @@ function resize_contents() {
   } */
 }
 
-function format_table(tid, dom, paging, pagelength, lengthmenu, header, highlight, selectable, serverside) {
+// How the per-column filters of a server-side table are applied (see COLUMN_FILTERS in
+// datams/db/datatables.py), any other column is searched for the text typed.  The
+// dates of a range are sent as `<from>|<to>` where either may be left empty.
+const RANGE_FILTERS = ['Uploaded', 'Deleted', 'Last Modified'];
+const EXACT_FILTERS = new Map([
+  ['Level', ['Organization', 'Deployment', 'Mooring Equipment', 'Unowned']],
+  ['Owner', null],  // typed in full
+]);
+const RANGE_DELIMITER = '|';
+const FILTER_DELAY = 400;  // milliseconds without typing before the table is filtered
+
+function add_column_filters(tid) {
+  // adds a row with the filter of every column under the header of the table
+  let thead = document.getElementById(tid).children[0];
+  let row = document.createElement('tr');
+  for (let th of thead.children[0].children) {
+    let name = th.innerText;
+    let cell = document.createElement('th');
+    if (RANGE_FILTERS.includes(name)) {
+      for (let bound of ['from', 'to']) {
+        let input = document.createElement('input');
+        input.type = 'date';
+        input.title = name + ' ' + bound;
+        input.className = 'form-control form-control-sm';
+        cell.appendChild(input);
+      }
+    } else if (EXACT_FILTERS.has(name) && EXACT_FILTERS.get(name) !== null) {
+      let select = document.createElement('select');
+      select.className = 'form-select form-select-sm';
+      for (let option of [''].concat(EXACT_FILTERS.get(name))) {
+        select.add(new Option(option, option));
+      }
+      cell.appendChild(select);
+    } else if (name != 'url') {
+      let input = document.createElement('input');
+      input.type = 'text';
+      input.placeholder = name;
+      input.className = 'form-control form-control-sm';
+      cell.appendChild(input);
+    }
+    row.appendChild(cell);
+  }
+  thead.appendChild(row);
+}
+
+function wire_column_filters(tid, table) {
+  // searches each column of the table by the value of its filter
+  let cells = document.getElementById(tid).children[0].children[1].children;
+  for (let i = 0; i < cells.length; i++) {
+    let inputs = Array.from(cells[i].querySelectorAll('input, select'));
+    if (inputs.length == 0) {
+      continue;
+    }
+    let timer = null;
+    let apply = function () {
+      let values = inputs.map((e) => e.value);
+      let value = values.every((v) => v == '') ? '' : values.join(RANGE_DELIMITER);
+      if (table.column(i).search() !== value) {
+        table.column(i).search(value).draw();
+      }
+    };
+    for (let input of inputs) {
+      if (input.type == 'text' && !EXACT_FILTERS.has(input.placeholder)) {
+        input.addEventListener('input', function () {
+          clearTimeout(timer);
+          timer = setTimeout(apply, FILTER_DELAY);
+        });
+      } else {
+        input.addEventListener('change', apply);
+      }
+    }
+  }
+}
+
+function format_table(tid, dom, paging, pagelength, lengthmenu, header, highlight, selectable, serverside, filters) {
   //For additional references see: https://datatables.net/examples/styling/bootstrap5.html
 
   // Check table header to see if the last column is 'url' if it is then we hide it set the onclick methods
@@ -131,10 +205,15 @@ function format_table(tid, dom, paging, pagelength, lengthmenu, header, highligh
       }
     );
   } else {
+    if (filters) {
+      add_column_filters(tid);
+    }
     var table = new DataTable(
       '#' + tid, {
           "serverSide": true,
           "ajax": serverside,
+          // the header is sorted by its first row, the second holding the filters
+          "orderCellsTop": true,
           "dom": dom,
           "paging": paging,
           "select": selectable,
@@ -151,6 +230,10 @@ function format_table(tid, dom, paging, pagelength, lengthmenu, header, highligh
   // add the table to our map
   tables.set(tid, table);
 
+  if (filters && serverside != "") {
+    wire_column_filters(tid, table);
+  }
+
   // set the click action to navigate to url if the url column is at the end
   if (url) {
     table.on('click', 'tbody td', to_url);
@@ -0,0 +1,265 @@
+import os
+import re
+import json
+import time
+import hashlib
+from werkzeug.utils import secure_filename
+
+from datams.utils import APP_CONFIG, PENDING_DIRECTORY
+from datams.redis import lock
+
+"""
+Receiver of the chunked uploads sent by Dropzone.
+
+The chunks of an upload may arrive in any order and in parallel (i.e. from different
+workers) so the temporary file `.temp.<username>.<uuid>` is preallocated to its full
+size when the first chunk arrives and every chunk is written at its own offset.  The
+chunks received so far are tracked by a bitmap kept in the state file
+`.chunks.<username>.<uuid>` next to it, the upload is complete once every bit is set.
+The state is only read and updated under a (redis) lock of the upload while the chunks
+themselves are written without holding it.
+
+Each chunk is copied from the (spooled) request stream to the file in buffers of
+BUFFER_SIZE bytes and hashed on the way so the memory used per request stays bounded
+regardless of the chunk size.
+
+The state also keeps the name, size and SHA-256 of every chunk received so that an
+interrupted upload can be resumed, even from another page: the client looks the upload
+up by the name, size and hash of the first chunk of its file (see upload_status),
+adopts its uuid and only sends the chunks that are missing or whose hash differs.  A
+chunk received again with the same hash isn't rewritten.  The state also records the
+uploads_id of the page that last sent a chunk, which is the one that submits it (see
+session_uploads).  The uploads that haven't received a chunk for UPLOAD_EXPIRY seconds
+are removed (see remove_stale_uploads) regardless of whether their page still checks
+in.
+
+Once complete the checksum of the upload is derived from these hashes (see
+upload_checksum) so it costs no extra pass over the file.  It is kept (in redis) with
+the pending file after the upload is submitted and stored with its File once processed.
+"""
+
+TEMP_PREFIX = '.temp.'
+STATE_PREFIX = '.chunks.'
+BUFFER_SIZE = 256 * 1024  # bytes
+# seconds an upload is kept (to be resumed or submitted) after its last chunk
+UPLOAD_EXPIRY = APP_CONFIG['DATA_FILES'].get('upload_expiry', 24 * 3600)
+# the uuids generated by Dropzone
+UUID_PATTERN = re.compile(r'[0-9a-f]{8}-([0-9a-f]{4}-){3}[0-9a-f]{12}')
+
+
+class UploadError(Exception):
+    """
+    This exception is raised when a chunk doesn't belong to or doesn't fit its upload.
+    """
+
+    def __init__(self, message):
+        self.message = message
+        super().__init__(self.message)
+
+
+def temp_path(username: str, uuid: str) -> str:
+    # the temporary file of the upload `uuid` of `username`
+    if UUID_PATTERN.fullmatch(uuid) is None:
+        raise UploadError('Invalid upload')
+    return os.path.join(PENDING_DIRECTORY,
+                        f"{TEMP_PREFIX}{secure_filename(username)}.{uuid}")
+
+
+def state_path(temp_path: str) -> str:
+    directory, name = os.path.split(temp_path)
+    return os.path.join(directory, f"{STATE_PREFIX}{name[len(TEMP_PREFIX):]}")
+
+
+def _load_state(path: str):
+    try:
+        with open(path, 'rt') as fp:
+            return json.load(fp)
+    except FileNotFoundError:
+        return None
+
+
+def _read_state(temp_path: str):
+    return _load_state(state_path(temp_path))
+
+
+def _user_states(username: str):
+    # yields the temporary file and the state of every upload of `username`
+    prefix = f"{STATE_PREFIX}{secure_filename(username)}."
+    for name in os.listdir(PENDING_DIRECTORY):
+        if not name.startswith(prefix) or name.endswith('.tmp'):
+            continue
+        state = _load_state(os.path.join(PENDING_DIRECTORY, name))
+        if state is not None:
+            yield (os.path.join(PENDING_DIRECTORY,
+                                f"{TEMP_PREFIX}{name[len(STATE_PREFIX):]}"), state)
+
+
+def _write_state(temp_path: str, state: dict):
+    # replaced rather than rewritten in place so the state is never partially written
+    path = state_path(temp_path)
+    with open(f"{path}.tmp", 'wt') as fp:
+        json.dump(state, fp)
+    os.replace(f"{path}.tmp", path)
+
+
+def _preallocate(path: str, size: int):
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644)
+    try:
+        try:
+            if size > 0:
+                os.posix_fallocate(fd, 0, size)
+        except (AttributeError, OSError):  # not supported by the platform/filesystem
+            os.ftruncate(fd, size)
+    finally:
+        os.close(fd)
+
+
+def _start(temp_path: str, uuid: str, chunk_size: int, chunk_count: int,
+           total_size: int, filename: str, uploads_id: str) -> dict:
+    # NOTE: the caller must hold the lock of the upload
+    state = _read_state(temp_path)
+    if state is None:
+        if os.path.exists(temp_path):
+            raise UploadError('File already exists')
+        _preallocate(temp_path, total_size)
+        state = dict(uuid=uuid, filename=filename, uploads_id=uploads_id,
+                     chunk_size=chunk_size, chunk_count=chunk_count,
+                     total_size=total_size, received='00' * ((chunk_count + 7) // 8),
+                     hashes={})
+        _write_state(temp_path, state)
+    elif (state['uuid'] != uuid or state.get('filename') != filename or
+          state['chunk_size'] != chunk_size or state['chunk_count'] != chunk_count or
+          state['total_size'] != total_size):
+        raise UploadError('File already exists')
+    return state
+
+
+def _copy_chunk(stream, fd, offset: int, size: int) -> str:
+    # copy the `size` bytes of `stream` to `offset` of `fd` (or only hash them if `fd`
+    # is None) returning their SHA-256
+    digest, copied = hashlib.sha256(), 0
+    while True:
+        # reading one byte past `size` tells if the chunk is too large
+        data = stream.read(min(BUFFER_SIZE, size - copied + 1))
+        if not data:
+            break
+        if copied + len(data) > size:
+            raise UploadError('Chunk size mismatch')
+        digest.update(data)
+        if fd is not None:
+            os.pwrite(fd, data, offset + copied)
+        copied += len(data)
+    if copied != size:
+        raise UploadError('Chunk size mismatch')
+    return digest.hexdigest()
+
+
+def receive_chunk(temp_path: str, stream, uuid: str, index: int, offset: int,
+                  chunk_size: int, chunk_count: int, total_size: int, filename: str,
+                  uploads_id: str) -> bool:
+    """
+    Write the chunk `index` of the upload `uuid` (of `filename` from the page
+    `uploads_id`) read from `stream` at `offset` of `temp_path` and return whether
+    every chunk of the upload has now been received.
+    """
+    expected = min(chunk_size, total_size - offset)
+    if not 0 <= index < chunk_count or offset != index * chunk_size or expected < 0:
+        raise UploadError('Chunk is out of range')
+    key = f"upload.{os.path.basename(temp_path)}"
+    with lock(key):
+        state = _start(temp_path, uuid, chunk_size, chunk_count, total_size, filename,
+                       uploads_id)
+
+    # a chunk sent again (i.e. when resuming) is only rewritten if it differs
+    known = state['hashes'].get(str(index))
+    digest = None if known is None else _copy_chunk(stream, None, 0, expected)
+    if digest is None or digest != known:
+        stream.seek(0)
+        fd = os.open(temp_path, os.O_WRONLY)
+        try:
+            digest = _copy_chunk(stream, fd, offset, expected)
+        finally:
+            os.close(fd)
+
+    with lock(key):
+        state = _read_state(temp_path)
+        if state is None or state['uuid'] != uuid:  # cancelled in the meantime
+            raise UploadError('Upload was cancelled')
+        received = bytearray.fromhex(state['received'])
+        received[index // 8] |= 1 << (index % 8)
+        state['received'] = received.hex()
+        state['hashes'][str(index)] = digest
+        state['uploads_id'] = uploads_id  # i.e. resumed from another page
+        complete = sum(bin(b).count('1') for b in received) == chunk_count
+        if complete:
+            state['checksum'] = _checksum(state)
+        _write_state(temp_path, state)
+    return complete
+
+
+def _checksum(state: dict) -> str:
+    # the SHA-256 of the (binary) SHA-256s of the chunks in order, prefixed with the
+    # algorithm and the chunk size needed to reproduce it
+    digest = hashlib.sha256()
+    for i in range(state['chunk_count']):
+        digest.update(bytes.fromhex(state['hashes'][str(i)]))
+    return f"sha256-{state['chunk_size']}:{digest.hexdigest()}"
+
+
+def upload_checksum(temp_path: str):
+    # the checksum of the complete upload to `temp_path` or None
+    state = _read_state(temp_path)
+    return None if state is None else state.get('checksum')
+
+
+def upload_status(username: str, filename: str, total_size: int,
+                  first_hash: str = None):
+    """
+    The uuid, size and the (index: SHA-256) of the chunks received of the upload of
+    `filename` of `username` with the same size and (when both are known) the same
+    SHA-256 of its first chunk, or None if there is no such upload
+    """
+    found = None
+    for _, state in _user_states(username):
+        known = state['hashes'].get('0')
+        if (state.get('filename') != filename or state['total_size'] != total_size or
+                (first_hash is not None and known is not None and known != first_hash)):
+            continue
+        # the most advanced of the matching uploads
+        if found is None or len(state['hashes']) > len(found['hashes']):
+            found = state
+    if found is None:
+        return None
+    return dict(uuid=found['uuid'], chunk_count=found['chunk_count'],
+                total_size=found['total_size'], chunks=found['hashes'])
+
+
+def session_uploads(username: str, uploads_id: str) -> list:
+    # the (temporary file, filename, checksum or None if incomplete) of the uploads
+    # last sent from the page `uploads_id`
+    return [(path, state['filename'], state.get('checksum'))
+            for path, state in _user_states(username)
+            if state.get('uploads_id') == uploads_id]
+
+
+def remove_upload(temp_path: str):
+    for path in [temp_path, state_path(temp_path)]:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+
+def remove_stale_uploads():
+    # the uploads (i.e. their temporary files and states) that haven't received a chunk
+    # for UPLOAD_EXPIRY seconds
+    threshold = time.time() - UPLOAD_EXPIRY
+    for name in os.listdir(PENDING_DIRECTORY):
+        if not (name.startswith(TEMP_PREFIX) or name.startswith(STATE_PREFIX)):
+            continue
+        path = os.path.join(PENDING_DIRECTORY, name)
+        try:
+            if os.path.isfile(path) and os.stat(path).st_mtime < threshold:
+                os.remove(path)
+        except FileNotFoundError:
+            continue
@@ -80,33 +80,6 @@ TIMEZONES = dict(
 TIMEZONES_R = {str(float(v)): k for k, v in TIMEZONES.items()}
 
 
-def update_and_append_to_checkins(checkins, value):
-    upload_id, timestamp = value
-    # remove valid checkins with same upload_id as the new value
-    checkins = [(uid, ts) for uid, ts in get_valid_checkins(checkins)
-                if uid != upload_id]
-    checkins.append(value)  # append the new value
-    return checkins
-
-
-def get_valid_checkins(checkins):
-    # return checkins that haven't yet expired
-    now = dt.datetime.now().timestamp()
-    checkins = [a for a in checkins if (now - a[1]) < REMOVE_STALES_EVERY]
-    return checkins
-
-
-def remove_stale_files(valid_uids):
-    temp_files = [f for f in os.listdir(PENDING_DIRECTORY)
-                  if (os.path.isfile(f"{PENDING_DIRECTORY}/{f}") and
-                      f.startswith('.temp'))]
-    to_remove = [f"{PENDING_DIRECTORY}/{f}" for f in temp_files
-                 if '.'.join(f[6:].split('.')[:2]) not in valid_uids]
-    for f in to_remove:
-        if os.path.isfile(f):
-            os.remove(f)
-
-
 def current_timestamp():
     return int(round(dt.datetime.now().timestamp()))
 
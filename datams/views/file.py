@@ -1,17 +1,22 @@
 import os
+import json
+import base64
+import binascii
 import pandas as pd
 import datetime as dt
 from flask import (Blueprint, render_template, request, redirect, send_file, url_for,
-                   jsonify, make_response, current_app)
+                   jsonify, make_response, current_app, Response, stream_with_context,
+                   flash)
 from flask_login import login_required, current_user
-from datams.celery import (update_task, compute_and_set_task, task_complete,
-                           update_vkey, set_working)
-from datams.redis import get_value
+from datams.celery import task_complete, update_vkey, refresh_keys
+from datams.redis import (get_value, add_checkin, listen_ready, set_checksums,
+                          pop_checksums)
 from datams.db.views import file_root, file_details
 from datams.db.requests import parse_request
 from datams.db.datatables import fetch
-from datams.db.utils import (resolve_filename, resolve_directory,
-                             check_directory_fullness)
+from datams.serialization import dumps_json, iter_json
+from datams.db.queries.select import search_files, list_files, LIST_ORDERS
+from datams.db.utils import allocate_path, release_path
 from datams.utils import PENDING_DIRECTORY, PROCESSED_DIRECTORY
 from werkzeug.utils import secure_filename
 from datams.db.queries.insert import insert_files
@@ -21,64 +26,95 @@ from sqlalchemy import select, insert
 from sqlalchemy import delete as sdelete
 from datams.db.core import query_all, query_df
 from datams.db.tables import File, DeletedFile
+from datams.discovery import set_discovered_state
+from datams.uploads import (receive_chunk, upload_status as _upload_status, temp_path,
+                            state_path, session_uploads, remove_upload, UploadError,
+                            UPLOAD_EXPIRY)
 
 # CHUNK_SIZE = 1000000  # ~1MB
+# an events stream is closed after this and the browser then reconnects by itself
+EVENTS_TIMEOUT = 60  # seconds
+EVENTS_KEEPALIVE = 15  # seconds
+# DataTables responses with more rows than this are streamed
+STREAM_ROWS = 5000
+SEARCH_LIMIT = 1000  # maximum number of results returned by the search api
+LIST_LIMIT = 1000  # maximum number of files per page returned by the listing api
 
 
 bp = Blueprint('file', __name__, url_prefix='/file')
 
+
+def _upload_name(name: str):
+    # the (uploads_id, filename) of a file renamed by Dropzone to
+    # `temp.<uploads_id>.<filename>` or None if it isn't uploaded by the current user
+    prefix = f"temp.{current_user.username}."
+    timestamp, _, filename = name[len(prefix):].partition('.')
+    if not name.startswith(prefix) or not filename:
+        return None
+    return f"{current_user.username}.{timestamp}", secure_filename(filename)
+
 # TODO: Put the query code from methods process, delete into the appropriate files
-# TODO: look into using celery with parallel chunk downloading to speed things up
-# TODO: Use multiprocessing to speed things up and start assembling the file in
-#       memory
 @bp.route("/upload", methods=('POST',))
 @login_required
 def upload():
+    # NOTE: the chunks may arrive out of order and in parallel (see datams.uploads)
     file = request.files['file']
-    save_path = os.path.join(
-        PENDING_DIRECTORY,
-        f".{secure_filename(file.filename)}"
-    )
-    current_app.logger.debug(save_path)
+    name = _upload_name(file.filename)
+    if name is None:
+        return make_response(('Not your upload', 403))
+    uploads_id, filename = name
     current_chunk = int(request.form['dzchunkindex'])
-
-    # If the file already exists it's ok if we are appending to it,
-    # but not if it's new file that would overwrite the existing one
-    if os.path.exists(save_path) and current_chunk == 0:
-        # 400 and 500s will tell dropzone that an error occurred and show an error
-        return make_response(('File already exists', 400))
+    total_chunks = int(request.form['dztotalchunkcount'])
     try:
-        with open(save_path, 'ab') as f:
-            f.seek(int(request.form['dzchunkbyteoffset']))
-            f.write(file.stream.read())
+        # NOTE: the upload is kept under its uuid (rather than its page) so it can be
+        #       resumed from another page
+        save_path = temp_path(current_user.username, request.form['dzuuid'])
+        current_app.logger.debug(save_path)
+        complete = receive_chunk(
+            save_path, file.stream, request.form['dzuuid'], current_chunk,
+            int(request.form['dzchunkbyteoffset']), int(request.form['dzchunksize']),
+            total_chunks, int(request.form['dztotalfilesize']), filename, uploads_id
+        )
+    except UploadError as error:
+        # 400 and 500s will tell dropzone that an error occurred and show an error
+        return make_response((error.message, 400))
     except OSError:
         # log.exception will include the traceback so we can see what's wrong
         current_app.logger.exception('Could not write to file')
         return make_response(("Not sure why, but we couldn't write the file to disk",
                               500))
-    total_chunks = int(request.form['dztotalchunkcount'])
-    if current_chunk + 1 == total_chunks:
-        # This was the last chunk, the file should be complete and the size we expect
-        if os.path.getsize(save_path) != int(request.form['dztotalfilesize']):
-            current_app.logger.error(f"File {file.filename} was completed, "
-                      f"but has a size mismatch."
-                      f"Was {os.path.getsize(save_path)} but we"
-                      f" expected {request.form['dztotalfilesize']} ")
-            return make_response(('Size mismatch', 500))
-        else:
-            filename = os.path.basename(save_path)
-            current_app.logger.info(f'File {filename} has been uploaded successfully')
+    if complete:
+        current_app.logger.info(f'File {filename} has been uploaded successfully')
     else:
         current_app.logger.debug(f'Chunk {current_chunk + 1} of {total_chunks} '
                   f'for file {file.filename} complete')
     return make_response(("Chunk upload successful", 200))
 
 
+@bp.route("/upload/status", methods=('GET',))
+@login_required
+def upload_status():
+    # lets the client resume an interrupted upload, possibly started from another page,
+    # of the file with this name, size and SHA-256 of its first chunk (see
+    # datams.uploads)
+    name = _upload_name(request.args['filename'])
+    if name is None or name[0] != request.args['uploads_id']:
+        return make_response(('Not your upload', 403))
+    try:
+        size = int(request.args['size'])
+    except ValueError:
+        return make_response(('Invalid size', 400))
+    status = _upload_status(current_user.username, name[1], size,
+                            request.args.get('hash') or None)
+    if status is None:
+        return make_response(('No such upload', 404))
+    return jsonify(status)
+
+
 @bp.route('/checkin', methods=('POST',))
 @login_required
 def checkin():
-    update_task.delay('checkins',
-                      (request.form['uploads_id'], dt.datetime.now().timestamp()))
+    add_checkin(request.form['uploads_id'], dt.datetime.now().timestamp())
     return make_response(("Successful check-in", 200))
 
 
@@ -89,14 +125,31 @@ def submit():
     # Check that the user portion of the uploads_id matches the current user
     if current_user.username == request.form['uploads_id'].split('.')[0]:
         uploads_id = request.form['uploads_id']
-        pending_files = [i for i in os.listdir(PENDING_DIRECTORY)
-                         if i.startswith(f".temp.{uploads_id}.")]
-        for f in pending_files:
-            cdir, cdir_idx, cdir_count = resolve_directory(PENDING_DIRECTORY)
-            f_new = resolve_filename(f[6:], cdir)
-            os.rename(f"{PENDING_DIRECTORY}/{f}", f"{cdir}/{f_new}")
-        set_working('pending_files')
-        compute_and_set_task.delay('pending_files')
+        checksums, incomplete = dict(), []
+        for f, filename, checksum in session_uploads(current_user.username,
+                                                     uploads_id):
+            # NOTE: only complete uploads have a checksum, the others are left (with
+            #       their state) to be resumed until they expire
+            if checksum is None:
+                incomplete.append(filename)
+                continue
+            f_new = allocate_path(PENDING_DIRECTORY, f"{uploads_id}.{filename}")
+            try:
+                os.rename(f, f_new)
+            except OSError as error:
+                current_app.logger.error(error)
+                release_path(PENDING_DIRECTORY, f_new)
+                continue
+            checksums[f_new] = checksum
+            os.remove(state_path(f))
+        set_checksums(checksums)
+        if incomplete:
+            current_app.logger.warning(f"Incomplete uploads of `{uploads_id}` were "
+                                       f"not submitted: {incomplete}")
+            flash(f"Not submitted as the upload didn't finish, add the files again "
+                  f"within {UPLOAD_EXPIRY // 3600} hours to resume their upload: "
+                  f"{', '.join(incomplete)}")
+        refresh_keys('pending_files')
     return redirect(f"{url_for('file.root')}?activetab=nav-pending-uploads")
 
 
@@ -106,11 +159,8 @@ def cancel():
     # Check that the user portion of the uploads_id matches the current user
     if current_user.username == request.form['uploads_id'].split('.')[0]:
         uploads_id = request.form['uploads_id']
-        pending_files = [f"{PENDING_DIRECTORY}/{i}"
-                         for i in os.listdir(PENDING_DIRECTORY)
-                         if i.startswith(f".temp.{uploads_id}.")]
-        for f in pending_files:
-            os.remove(f)
+        for f, _, _ in session_uploads(current_user.username, uploads_id):
+            remove_upload(f)
     return redirect(request.referrer)
 
 
@@ -126,7 +176,7 @@ def delete():
         df = query_df(select(
             File.id, File.organization_id, File.deployment_id,
             File.mooring_equipment_id, File.path, File.name, File.description,
-            File.uploaded, File.comments
+            File.uploaded, File.comments, File.checksum
         ).where(File.id.in_(indexes)))
         df['ftype'] = 'processed_file'
         df['deleted'] = int(round(dt.datetime.now().timestamp()))
@@ -135,16 +185,15 @@ def delete():
         # insert these into deleted files and remove these from the File table
         query_all([insert(DeletedFile).values(**v) for v in values] +
                   [sdelete(File).where(File.id.in_(indexes))])
-        set_working('processed_files')
-        set_working('deleted_files')
-        compute_and_set_task.delay('processed_files')
-        compute_and_set_task.delay('deleted_files')
+        refresh_keys('deleted_files', changes=dict(processed_files=indexes))
 
     elif ftype == 'pending_files':
         active_tab = 'nav-pending-uploads'
         indexes = values.pop('indexes')
         # get all the indexes from the table
-        df = get_value(f"vkey.{uploads_id}.pending_files").drop(columns=['uploaded_by'])
+        df = get_value(f"vkey.{uploads_id}.pending_files")[
+            ['id', 'filepath', 'filename', 'uploaded']
+        ]
         df = df.loc[df['id'].isin(indexes), :]
         df['ftype'] = 'pending_file'
         df['deleted'] = int(round(dt.datetime.now().timestamp()))
@@ -154,13 +203,23 @@ def delete():
         )
         df = df.rename(columns={'id': 'original_id', 'filepath': 'path',
                                 'filename': 'name'})
+        # the checksums of the uploads are kept with them once deleted
+        df['checksum'] = pop_checksums(df['path'].tolist())
         values = [v for v in df.transpose().to_dict().values()]
         # insert these into deleted files and remove these from the File table
         query_all([insert(DeletedFile).values(**v) for v in values])
-        set_working('pending_files')
-        set_working('deleted_files')
-        compute_and_set_task.delay('pending_files')
-        compute_and_set_task.delay('deleted_files')
+        refresh_keys('pending_files', 'deleted_files')
+
+    elif ftype == 'discovered_files':
+        # NOTE: discovered files are never removed from the discovery directory, they
+        #       are only ignored (i.e. no longer listed until the unignore-files
+        #       command lists them again)
+        active_tab = 'nav-pending-discoveries'
+        indexes = values.pop('indexes')
+        df = get_value(f"vkey.{uploads_id}.discovered_files")
+        paths = df.loc[df['id'].isin(indexes), 'filepath'].tolist()
+        set_discovered_state(paths, 'ignored')
+        refresh_keys('discovered_files')
 
     return redirect(f"{url_for('file.root')}?activetab={active_tab}")
 
@@ -174,15 +233,20 @@ def restore():
     stmt = select(DeletedFile.id, DeletedFile.original_id, DeletedFile.organization_id,
                   DeletedFile.deployment_id, DeletedFile.mooring_equipment_id,
                   DeletedFile.path, DeletedFile.name, DeletedFile.description,
-                  DeletedFile.uploaded, DeletedFile.comments, DeletedFile.ftype)
+                  DeletedFile.uploaded, DeletedFile.comments, DeletedFile.checksum,
+                  DeletedFile.ftype)
     df = query_df(stmt)
     df = (
         df.loc[df['id'].isin(indexes), :]
           .drop(columns=['id'])
           .rename(columns={'original_id': 'id'})
     )
+    # the pending files are listed again once their rows are deleted so their checksums
+    # are put back with them (see delete)
+    pending = df.loc[(df['ftype'] == 'pending_file') & df['checksum'].notna(), :]
+    checksums = dict(zip(pending['path'], pending['checksum']))
     df = df.loc[df['ftype'] == 'processed_file', :].drop(columns=['ftype'])
-    refresh_processed = df.shape[0] != 0
+    restored_ids = [int(i) for i in df['id']]
     # values = [v for v in df.transpose().to_dict().values()]
     values = []
     for entry in df.transpose().to_dict().values():
@@ -191,19 +255,14 @@ def restore():
             if not pd.isna(v):
                 value[k] = v
         values.append(value)
+    set_checksums(checksums)
     # insert these into files and remove these from the DeletedFile table
     # FIXME: When trying to restore this will cause problems if the foreign keys no
     #        longer exist
     query_all([insert(File).values(**v) for v in values] +
               [sdelete(DeletedFile).where(DeletedFile.id.in_(indexes))])
-    set_working('pending_files')
-    set_working('deleted_files')
-    if refresh_processed:
-        set_working('processed_files')
-    compute_and_set_task.delay('pending_files')
-    compute_and_set_task.delay('deleted_files')
-    if refresh_processed:
-        compute_and_set_task.delay('processed_files')
+    refresh_keys('pending_files', 'deleted_files',
+                 changes=dict(processed_files=restored_ids) if restored_ids else None)
     return redirect(f"{url_for('file.root')}?activetab=nav-deleted")
 
 
@@ -217,63 +276,62 @@ def process():
 
     active_tab = 'nav-processed'
     if ftype == 'processed_files':
+        indexes = values['indexes']
         update_files(values)
-        set_working('processed_files')
-        compute_and_set_task.delay('processed_files')
+        refresh_keys(changes=dict(processed_files=indexes))
 
     if ftype == 'pending_files':
         active_tab = 'nav-pending-uploads'
         indexes = values.pop('indexes')
         df = get_value(f"vkey.{uploads_id}.pending_files")
-        cdir, cdir_idx, cdir_count = resolve_directory(PROCESSED_DIRECTORY)
         moves, paths, names = [], [], []
         for idx in indexes:
-            cdir, cdir_idx, cdir_count = check_directory_fullness(
-                PROCESSED_DIRECTORY, cdir_idx, cdir_count
-            )
             try:
                 filepath = df.loc[df['id'] == idx, 'filepath'].iloc[0]
                 name = df.loc[df['id'] == idx, 'filename'].iloc[0]
-                if os.path.exists(filepath):
-                    new_filepath = f"{cdir}/{secure_filename(os.path.basename(filepath))}"
-                os.rename(filepath, new_filepath)
+                new_filepath = allocate_path(
+                    PROCESSED_DIRECTORY, secure_filename(os.path.basename(filepath))
+                )
+                try:
+                    os.rename(filepath, new_filepath)
+                except OSError:
+                    release_path(PROCESSED_DIRECTORY, new_filepath)
+                    raise
                 paths.append(new_filepath)
                 names.append(name)
                 moves.append((filepath, new_filepath))
-                cdir_count += 1
             except Exception as error:  # TODO: use specific errors
                 # TODO: Flash this error with the files that didn't work to the user
                 current_app.logger.error(error)
         values['paths'] = paths
         values['names'] = names
+        checksums = pop_checksums([path_orig for path_orig, _ in moves])
+        values['checksums'] = checksums
+        file_ids = []
         try:
-            insert_files(values)
+            file_ids = insert_files(values)
+            for path_orig, _ in moves:
+                release_path(PENDING_DIRECTORY, path_orig)
         except Exception as error:  # TODO: use specific errors
             # TODO: Flash this error and inform user of rollback
             current_app.logger.error(error)
             # rollback all the renames
             for path_orig, path_new in moves:
                 os.rename(path_new, path_orig)
-        set_working('processed_files')
-        set_working('pending_files')
-        compute_and_set_task.delay('processed_files')
-        compute_and_set_task.delay('pending_files')
+                release_path(PROCESSED_DIRECTORY, path_new)
+            set_checksums({path_orig: checksum for (path_orig, _), checksum
+                           in zip(moves, checksums) if checksum is not None})
+        refresh_keys('pending_files', changes=dict(processed_files=file_ids))
 
     elif ftype == 'discovered_files':
         active_tab = 'nav-pending-discoveries'
         indexes = values.pop('indexes')
         df = get_value(f"vkey.{uploads_id}.discovered_files")
-        touches, paths, names = [], [], []
+        paths, names = [], []
         for idx in indexes:
             try:
                 filepath = df.loc[df['id'] == idx, 'filepath'].iloc[0]
                 name = os.path.basename(df.loc[df['id'] == idx, 'filename'].iloc[0])
-                current_app.logger.debug(filepath)
-                current_app.logger.debug(type(filepath))
-                touch = f"{filepath}.touch"
-                with open(touch, 'at') as fp:
-                    pass
-                touches.append(touch)
                 paths.append(filepath)
                 names.append(name)
             except Exception as error:  # TODO: use specific errors
@@ -282,18 +340,14 @@ def process():
 
         values['paths'] = paths
         values['names'] = names
+        file_ids = []
         try:
-            insert_files(values)
+            file_ids = insert_files(values)
+            set_discovered_state(paths, 'processed')
         except Exception as error:  # TODO: use specific errors
             # TODO: Flash this error and inform user of rollback
             current_app.logger.error(error)
-            # rollback all the touches
-            for touch in touches:
-                os.remove(touch)
-        set_working('processed_files')
-        set_working('discovered_files')
-        compute_and_set_task.delay('processed_files')
-        compute_and_set_task.delay('discovered_files')
+        refresh_keys('discovered_files', changes=dict(processed_files=file_ids))
 
     # TODO: Implement this will take the information it needs from the form
     return redirect(f"{url_for('file.root')}?activetab={active_tab}")
@@ -345,7 +399,6 @@ def root():
 @bp.route("/refresh/<vkey>", methods=('GET',))
 @login_required
 def refresh(vkey: str):
-    set_working(vkey)
     update_vkey(vkey)
     return make_response((f"Request for refresh submitted", 200))
 
@@ -357,11 +410,110 @@ def ready(key):
     return jsonify(dict(ready=is_ready))
 
 
+@bp.route("/events", methods=('GET',))
+@login_required
+def events():
+    # Server-Sent Events stream emitting a `ready` event with the key as data whenever
+    # one of the requested keys (i.e. ?key=<vkey>&key=<vkey>) is ready
+    keys = request.values.getlist('key')
+
+    def generate():
+        yield "retry: 1000\n\n"
+        for key in listen_ready(keys, EVENTS_TIMEOUT, EVENTS_KEEPALIVE):
+            yield ": keepalive\n\n" if key is None else f"event: ready\ndata: {key}\n\n"
+
+    return Response(stream_with_context(generate()), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+
 @bp.route("/ajax", methods=('GET',))
 @login_required
 def ajax():
     # This routes below provide server-side computations for datatables (used by files)
-    return jsonify(fetch(request))
+    response = fetch(request)
+    if len(response['data']) > STREAM_ROWS:
+        return Response(iter_json(response, 'data'), mimetype='application/json')
+    return Response(dumps_json(response), mimetype='application/json')
+
+
+@bp.route("/search", methods=('GET',))
+@login_required
+def search():
+    # full-text search api i.e. /file/search?q=<words>&ftype=processed_files&limit=50
+    # returning a list of the matching files ordered by relevance
+    request_values = request.values
+    ftype = request_values.get('ftype', 'processed_files')
+    if ftype not in ['processed_files', 'deleted_files']:
+        return make_response(jsonify(error=f"Unsupported ftype: `{ftype}`"), 400)
+    try:
+        limit = min(int(request_values.get('limit', 50)), SEARCH_LIMIT)
+    except ValueError:
+        return make_response(jsonify(error="limit must be an integer"), 400)
+    if limit < 1:
+        return make_response(jsonify(error="limit must be at least 1"), 400)
+    df = search_files(request_values.get('q', ''), deleted=ftype == 'deleted_files',
+                      limit=limit)
+    return jsonify(df.astype(object).where(df.notna(), None).to_dict(orient='records'))
+
+
+def _encode_cursor(cursor: list) -> str:
+    return base64.urlsafe_b64encode(json.dumps(cursor).encode('utf-8')).decode('ascii')
+
+
+def _decode_cursor(cursor: str) -> list:
+    return json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+
+
+def _is_integer(value) -> bool:
+    # i.e. fits the (32-bit) integer columns
+    return (isinstance(value, int) and not isinstance(value, bool) and
+            -2 ** 31 <= value < 2 ** 31)
+
+
+def _valid_cursor(order_by: str, ascending, after: list) -> bool:
+    # the values of a (decoded) cursor must match the types of the order's columns
+    if not isinstance(ascending, bool) or len(after) != 2:
+        return False
+    value, index = after
+    valid = isinstance(value, str) if order_by == 'filename' else _is_integer(value)
+    return valid and _is_integer(index)
+
+
+@bp.route("/list", methods=('GET',))
+@login_required
+def list_():
+    # Keyset paginated listing of the processed files for scripted clients i.e.
+    #   /file/list?order_by=uploaded&dir=asc&limit=100
+    # followed by /file/list?cursor=<next> (with the `next` of the previous page) until
+    # `next` is null.  The cursor also holds the order so only the limit can change.
+    request_values = request.values
+    try:
+        limit = min(int(request_values.get('limit', 100)), LIST_LIMIT)
+        if limit < 1:
+            raise ValueError("limit must be at least 1")
+        if 'cursor' in request_values:
+            order_by, ascending, *after = _decode_cursor(request_values['cursor'])
+        else:
+            order_by = request_values.get('order_by', 'uploaded')
+            ascending, after = request_values.get('dir', 'asc') != 'desc', None
+        if order_by not in LIST_ORDERS.keys():
+            raise ValueError(f"Unsupported order_by: `{order_by}`")
+        if after is not None and not _valid_cursor(order_by, ascending, after):
+            raise ValueError("Malformed cursor")
+    except (ValueError, TypeError, binascii.Error) as error:
+        return make_response(jsonify(error=f"Invalid request: {error}"), 400)
+
+    df = list_files(order_by, ascending, after, limit)
+    cursor = None
+    if df.shape[0] == limit:
+        last = df.iloc[-1]
+        value = last[order_by] if order_by == 'filename' else int(last[order_by])
+        cursor = _encode_cursor([order_by, ascending, value, int(last['id'])])
+    df['uploaded'] = df['uploaded'].apply(
+        lambda x: dt.datetime.fromtimestamp(x).strftime('%Y-%m-%d %H:%M:%S')
+    )
+    data = df.astype(object).where(df.notna(), None).to_dict(orient='records')
+    return jsonify(data=data, next=cursor)
 
 # TODO: Take the chunking part out of this and put it into downloads, but keep it
 #       commented out until there is time to implement it
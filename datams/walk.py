@@ -0,0 +1,70 @@
+import os
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+from datams.utils import APP_CONFIG
+
+"""
+Parallel directory walker.
+
+Listing a directory on a network filesystem (i.e. NFS) is dominated by the latency of
+each request rather than by the amount of work, so the directories are listed
+concurrently on a bounded pool of threads.  The entries come from `os.scandir` whose
+cached type information (and stat results on some platforms) avoid stat'ing each file
+again afterwards.
+"""
+
+# maximum number of directories listed concurrently
+WALK_WORKERS = APP_CONFIG['DATA_FILES'].get('walk_workers', 8)
+
+
+def walk(roots: list, visit, workers: int = WALK_WORKERS):
+    """
+    Calls `visit(directory)` for every directory reachable from `roots` using a pool of
+    `workers` threads.  `visit` returns a `(result, subdirectories)` tuple, the results
+    are yielded as soon as they are available (in no particular order) and the
+    subdirectories are visited in turn.
+    """
+    pool = ThreadPoolExecutor(max_workers=workers)
+    pending = {pool.submit(visit, root) for root in roots}
+    try:
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                result, subdirectories = future.result()
+                pending |= {pool.submit(visit, d) for d in subdirectories}
+                yield result
+    finally:  # stop early when the caller stops iterating or a visit failed
+        for future in pending:
+            future.cancel()
+        pool.shutdown(wait=True)
+
+
+def _list_files(directory: str) -> tuple:
+    files, subdirectories = [], []
+    try:
+        with os.scandir(directory) as it:
+            for entry in it:
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        subdirectories.append(entry.path)
+                    elif entry.is_file():
+                        files.append(entry)
+                except OSError:  # removed while listing
+                    continue
+    except (FileNotFoundError, NotADirectoryError, PermissionError):
+        pass
+    return files, subdirectories
+
+
+def walk_files(root: str, workers: int = WALK_WORKERS):
+    """
+    yields an `os.DirEntry` for every file within `root` (symbolic links to directories
+    aren't followed)
+    """
+    for files in walk([root], _list_files, workers):
+        yield from files
+
+
+def realpath(entry: os.DirEntry) -> str:
+    # NOTE: assumes the walked root is itself a real path so only links need resolving
+    return os.path.realpath(entry.path) if entry.is_symlink() else entry.path
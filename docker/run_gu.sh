@@ -2,4 +2,4 @@
 
 
 cd ${DATAMS_ROOT}
-gunicorn --workers=3 'datams:create_app()'
\ No newline at end of file
+gunicorn --workers=3 --worker-class=gthread --threads=16 'datams:create_app()'
\ No newline at end of file